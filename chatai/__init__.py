@@ -1,9 +1,13 @@
 import os
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 
 
 # Set up OpenAI client
 OPENAI_CLIENT = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
 # Set up DeepSeek API client
-DEEPSEEK_CLIENT = OpenAI(api_key=os.getenv("DEEPSEEK_API_KEY"), base_url="https://api.deepseek.com/v1")
\ No newline at end of file
+DEEPSEEK_CLIENT = OpenAI(api_key=os.getenv("DEEPSEEK_API_KEY"), base_url="https://api.deepseek.com/v1")
+
+# Async counterparts, used from the bot's event loop
+ASYNC_OPENAI_CLIENT = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+ASYNC_DEEPSEEK_CLIENT = AsyncOpenAI(api_key=os.getenv("DEEPSEEK_API_KEY"), base_url="https://api.deepseek.com/v1")
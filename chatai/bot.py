@@ -1,22 +1,28 @@
-import base64
+import asyncio
 import os
 import yaml
 import traceback
 import signal
 import atexit
+import time
 
 from crontab import CronTab
-from telegram import Update, Message
-from telegram.ext import ApplicationBuilder, MessageHandler, filters, CallbackContext
-from typing import Optional
-from sqlalchemy.exc import SQLAlchemyError
-
-from chatai import OPENAI_CLIENT, DEEPSEEK_CLIENT
-from chatai.util import MessageCache
-from chatai.type_names import ChatMessage
+from sqlalchemy import select
+from telegram import Update, Message, PhotoSize
+from telegram.error import BadRequest, RetryAfter, TelegramError
+from telegram.ext import Application, ApplicationBuilder, MessageHandler, filters, CallbackContext
+from typing import List, Optional, Sequence, Tuple
+
+from chatai.completion import AsyncCompletionBackend
+from chatai.completion_cache import CompletionCache
+from chatai.util import MessageCache, EncodingCache
+from chatai.type_names import ChatMessage, CompletionMessage
+from chatai.image import ImageStore, select_photo_size, downscale
 from chatai.prompt.chat import Chat
-# from chatai.sql import Session
-# from chatai.sql.tables import Message as MessageRow
+from chatai.prompt.retrieval import FactRetriever, create_embedder
+from chatai.sql import engine
+from chatai.sql.tables import Message as MessageRow, MessageImage as MessageImageRow, Memory
+from chatai.sql.writer import WriteBehindQueue
 from chatai.memory.schedule import get_shutdown_handler, create_cron_job, remove_cron_job
 
 # Define the Telegram bot token
@@ -27,10 +33,66 @@ with open("chatai/config.yaml", "r") as f:
     CONFIG = yaml.safe_load(f)
     
 # Remember messages to feed as context
-MESSAGE_CACHE = MessageCache(CONFIG["serving"]["max_messages_in_memory"])
+MESSAGE_CACHE = MessageCache(
+    CONFIG["serving"]["max_messages_in_memory"],
+    CONFIG["serving"]["max_total_messages_in_memory"],
+)
+
+COMPLETION_CACHE = None
+if CONFIG["serving"]["completion_cache"]["enabled"]:
+    COMPLETION_CACHE = CompletionCache(
+        CONFIG["serving"]["completion_cache"]["max_entries"],
+        CONFIG["serving"]["completion_cache"]["ttl_seconds"],
+        CONFIG["serving"]["completion_cache"]["path"] or None,
+        max_disk_entries=CONFIG["serving"]["completion_cache"]["max_disk_entries"],
+    )
+
+# Non-blocking completions, bounded per vendor
+COMPLETIONS = AsyncCompletionBackend(CONFIG["serving"]["max_concurrent_completions"], cache=COMPLETION_CACHE)
+
+# Downscaled photos, deduplicated by Telegram file_unique_id
+IMAGE_STORE = ImageStore(CONFIG["serving"]["images"]["store_path"])
+
+# Rate-limited retries of the last edit of a streamed reply
+FINAL_EDIT_ATTEMPTS = 3
+
+# Messages are persisted in batches off the hot path
+MESSAGE_WRITER = WriteBehindQueue(
+    engine,
+    CONFIG["serving"]["message_writer"]["flush_interval_ms"],
+    CONFIG["serving"]["message_writer"]["max_batch_rows"],
+)
+
+def load_recent_memories() -> List[Tuple[str, str]]:
+    earliest_ts = int(time.time()) - CONFIG["serving"]["fact_retrieval"]["lookback_days"] * 24 * 60 * 60
+    statement = select(Memory.character_name, Memory.fact).where(Memory.start_unixtime >= earliest_ts)
+    with engine.connect() as connection:
+        return [(row.character_name, row.fact) for row in connection.execute(statement)]
+
+FACT_RETRIEVER = None
+if CONFIG["serving"]["fact_retrieval"]["enabled"]:
+    FACT_RETRIEVER = FactRetriever(
+        create_embedder(CONFIG["serving"]["fact_retrieval"]),
+        CONFIG["serving"]["fact_retrieval"]["top_k"],
+        CONFIG["serving"]["fact_retrieval"]["character_boost"],
+        load_recent_memories,
+    )
+
+# Prompt is re-parsed only when chatai/prompt.yaml changes
+CHAT = Chat(
+    "chatai/prompt.yaml",
+    CONFIG["serving"]["stable_prompt"],
+    EncodingCache(
+        CONFIG["serving"]["encoding_cache"]["max_bytes"],
+        CONFIG["serving"]["encoding_cache"]["max_item_bytes"],
+    ),
+    IMAGE_STORE,
+    FACT_RETRIEVER,
+)
 
 # Function to handle user messages
 async def handle_message(update: Update, context: CallbackContext):
+    received_at = time.monotonic()
     try:
         if not update.message.chat.type == "private" and not update.message.text and not update.message.caption:
             return
@@ -38,26 +100,30 @@ async def handle_message(update: Update, context: CallbackContext):
         # Get the user's message
         chat_message = await parse_message(update.message, context)
         # Persist in context for future trend extraction
-        # log_message(chat_message, update)
+        log_message(chat_message, update)
 
         # Abort if should not respond
         if not should_respond(update):
             return
 
         # Add to cache
-        MESSAGE_CACHE.add_message(chat_message)
+        await MESSAGE_CACHE.add_message(update.effective_chat.id, chat_message)
 
-        prompt = Chat("chatai/prompt.yaml")
-        prev_messages = MESSAGE_CACHE.get_last_n_messages(
+        prev_messages = await MESSAGE_CACHE.get_last_n_messages(
+            update.effective_chat.id,
             CONFIG["serving"]["max_messages_in_memory"],
         )
         if update.message.text == "!контекст":
-            await update.message.reply_text(str(prompt.generate(prev_messages)[1:]))
+            await update.message.reply_text(str((await generate_messages(prev_messages))[1:]))
+            return
+        if CONFIG["serving"]["streaming"]["enabled"]:
+            await stream_reply(update, await generate_messages(prev_messages), received_at)
             return
-        llm_client = DEEPSEEK_CLIENT if CONFIG["model"]["vendor"] == "deepseek" else OPENAI_CLIENT
-        response = llm_client.chat.completions.create(
+        response = await COMPLETIONS.create(
+            CONFIG["model"]["vendor"],
+            use_cache=True,
             model=CONFIG["model"]["name"],
-            messages=prompt.generate(prev_messages),
+            messages=await generate_messages(prev_messages),
             max_tokens=300,
             n=1,
             temperature=0.7,
@@ -67,12 +133,95 @@ async def handle_message(update: Update, context: CallbackContext):
 
         # Send the response back to the user
         await update.message.reply_text(gpt_response)
+        print(f"Time to first visible token: {time.monotonic() - received_at:.2f}s")
 
     except Exception as e:
         # Optional: Log the error for debugging
         print(f"Error: {e}")
         await update.message.reply_text(traceback.format_exc())
 
+async def generate_messages(messages: List[ChatMessage]) -> List[CompletionMessage]:
+    # A changed prompt rebuilds the fact index with a database read; that happens off the event loop
+    if FACT_RETRIEVER is not None:
+        await asyncio.to_thread(FACT_RETRIEVER.refresh, CHAT.prompt_config_file_path)
+    return CHAT.generate(messages)
+
+async def stream_reply(update: Update, messages: List[CompletionMessage], received_at: float):
+    streaming_config = CONFIG["serving"]["streaming"]
+    reply = await update.message.reply_text(streaming_config["placeholder"])
+
+    text = ""
+    sent_text = ""
+    next_edit_at = 0.0
+    try:
+        async for chunk in COMPLETIONS.stream(
+            CONFIG["model"]["vendor"],
+            model=CONFIG["model"]["name"],
+            messages=messages,
+            max_tokens=300,
+            n=1,
+            temperature=0.7,
+        ):
+            if not chunk.choices or not chunk.choices[0].delta.content:
+                continue
+            text += chunk.choices[0].delta.content
+
+            # Rate-limit intermediate edits to stay within Telegram's per-chat edit limits
+            now = time.monotonic()
+            if now < next_edit_at or len(text) - len(sent_text) < streaming_config["min_chunk_chars"] or not text.strip():
+                continue
+            try:
+                edited = await _edit_reply(reply, text.strip())
+            except RetryAfter as e:
+                next_edit_at = now + e.retry_after
+                continue
+            next_edit_at = now + streaming_config["edit_interval_seconds"]
+            if not edited:
+                continue
+            if not sent_text:
+                print(f"Time to first visible token: {now - received_at:.2f}s")
+            sent_text = text
+    finally:
+        # Whatever was generated replaces the placeholder, also when the stream fails midway
+        await _finalize_reply(reply, text.strip(), sent_text.strip(), received_at)
+
+async def _finalize_reply(reply: Message, final_text: str, sent_text: str, received_at: float):
+    if not final_text:
+        # Nothing to show, the placeholder must not stay in the chat
+        try:
+            await reply.delete()
+        except TelegramError as e:
+            print(f"Error deleting placeholder: {e}")
+        return
+    if final_text == sent_text:
+        return
+    for _ in range(FINAL_EDIT_ATTEMPTS):
+        try:
+            edited = await _edit_reply(reply, final_text)
+        except RetryAfter as e:
+            await asyncio.sleep(e.retry_after)
+            continue
+        if edited and not sent_text:
+            print(f"Time to first visible token: {time.monotonic() - received_at:.2f}s")
+        return
+    print(f"Gave up on the final edit after {FINAL_EDIT_ATTEMPTS} rate-limited attempts")
+
+async def _edit_reply(reply: Message, text: str) -> bool:
+    # True if the reply now shows the text. Rate limits are left to the caller, other errors don't abort the reply.
+    try:
+        await reply.edit_text(text)
+    except RetryAfter:
+        raise
+    except BadRequest as e:
+        if "message is not modified" in e.message.lower():
+            return True
+        print(f"Error editing reply: {e}")
+        return False
+    except TelegramError as e:
+        print(f"Error editing reply: {e}")
+        return False
+    return True
+
 def should_respond(update: Update) -> bool:
     if update.message.chat.type == "private":
         return True
@@ -102,59 +251,79 @@ async def parse_message(message: Message, context: CallbackContext) -> ChatMessa
 
     text = message.text or message.caption or ""
 
-    # Get the list of photos (Telegram sends different sizes, choose the highest resolution)
-    encoded_image = None
+    # Telegram sends different sizes, store a downscaled copy of the smallest adequate one
+    image_handle = None
     if message.photo is not None and len(message.photo) > 0:
-        photo = list(message.photo)[-1]  # Get the largest size
-        file = await context.bot.get_file(photo.file_id)
-        image_bytes = await file.download_as_bytearray()
-        encoded_image = base64.b64encode(image_bytes).decode("utf-8")
+        image_handle = await load_photo(message.photo, context)
     return ChatMessage(
         message.from_user.username,
         text,
         int(message.date.timestamp()),
-        encoded_image,
+        None,
         parsed_reply,
+        image_handle,
+    )
+
+async def load_photo(sizes: Sequence[PhotoSize], context: CallbackContext) -> str:
+    images_config = CONFIG["serving"]["images"]
+    photo = select_photo_size(sizes, images_config["max_edge"])
+    handle = IMAGE_STORE.get_handle(photo.file_unique_id)
+    if handle is None:
+        file = await context.bot.get_file(photo.file_id)
+        image_bytes = await file.download_as_bytearray()
+        image_bytes = await asyncio.to_thread(
+            downscale, bytes(image_bytes), images_config["max_edge"], images_config["jpeg_quality"],
+        )
+        handle = IMAGE_STORE.put(image_bytes, photo.file_unique_id)
+    return handle
+
+def log_message(message: ChatMessage, update: Update):
+    _enqueue_rows(
+        message,
+        update.message.id,
+        update.effective_chat.id,
+        update.message.reply_to_message.id if update.message.reply_to_message else None,
+    )
+
+    if message.reply_to_message:
+        _enqueue_rows(
+            message.reply_to_message,
+            update.message.reply_to_message.id,
+            update.effective_chat.id,
+            None,
+        )
+
+def _enqueue_rows(message: ChatMessage, message_id: int, chat_id: int, reply_to_id: Optional[int]):
+    MESSAGE_WRITER.put(
+        MessageRow.__table__,
+        dict(
+            id=message_id,
+            chat_id=chat_id,
+            username=message.username,
+            text=message.text,
+            unixtime=message.unixtime,
+            reply_to_message_id=reply_to_id,
+        ),
     )
+    if message.image_handle is not None:
+        MESSAGE_WRITER.put(
+            MessageImageRow.__table__,
+            dict(
+                message_id=message_id,
+                chat_id=chat_id,
+                data=IMAGE_STORE.read(message.image_handle),
+            ),
+        )
 
-# def log_message(message: ChatMessage, update: Update):
-#     try:
-#         session = Session()
-#
-#         message_row = _build_orm(
-#             message,
-#             update.message.id,
-#             update.effective_chat.id,
-#             update.message.reply_to_message.id if update.message.reply_to_message else None,
-#         )
-#         session.add(message_row)
-#
-#         if message.reply_to_message:
-#             reply_message_row = _build_orm(
-#                 message.reply_to_message,
-#                 update.message.reply_to_message.id,
-#                 update.effective_chat.id,
-#                 None,
-#             )
-#             session.merge(reply_message_row)
-#
-#         session.commit()
-#     except SQLAlchemyError as e:
-#         session.rollback()
-#         raise e
-#     finally:
-#         session.close()
-#
-# def _build_orm(message: ChatMessage, message_id: int, chat_id: int, reply_to_id: Optional[int]) -> MessageRow:
-#     return MessageRow(
-#         id=message_id,
-#         chat_id=chat_id,
-#         username=message.username,
-#         text=message.text,
-#         unixtime=message.unixtime,
-#         image_b64_encoded=message.image_b64_encoded,
-#         reply_to_message_id=reply_to_id,
-#     )
+async def start_message_writer(app: Application):
+    MESSAGE_WRITER.start()
+    # The first request doesn't pay for building the fact index
+    if FACT_RETRIEVER is not None:
+        await asyncio.to_thread(FACT_RETRIEVER.refresh, CHAT.prompt_config_file_path)
+
+async def stop_message_writer(app: Application):
+    await MESSAGE_WRITER.close()
+    print(f"Message writer stopped: {MESSAGE_WRITER.metrics()}")
 
 # Main function to start the bot
 def main():
@@ -166,7 +335,15 @@ def main():
     # atexit.register(lambda: remove_cron_job(cron))
     # create_cron_job(cron)
 
-    app = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).build()
+    # Let handlers for different chats await their completions concurrently
+    app = (
+        ApplicationBuilder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .concurrent_updates(True)
+        .post_init(start_message_writer)
+        .post_shutdown(stop_message_writer)
+        .build()
+    )
     filt = ~filters.COMMAND
     app.add_handler(MessageHandler(filt, handle_message))
 
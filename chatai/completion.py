@@ -0,0 +1,73 @@
+import asyncio
+from typing import Dict, Optional
+
+from openai import AsyncOpenAI
+
+from chatai import ASYNC_OPENAI_CLIENT, ASYNC_DEEPSEEK_CLIENT
+from chatai.completion_cache import CompletionCache
+
+
+class AsyncCompletionBackend:
+    def __init__(
+            self,
+            max_concurrent_requests: Dict[str, int],
+            clients: Optional[Dict[str, AsyncOpenAI]] = None,
+            cache: Optional[CompletionCache] = None,
+    ):
+        self.cache = cache
+        self.clients = clients or {
+            "openai": ASYNC_OPENAI_CLIENT,
+            "deepseek": ASYNC_DEEPSEEK_CLIENT,
+        }
+        self.max_concurrent_requests = max_concurrent_requests
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+
+    def get_client(self, vendor: str) -> AsyncOpenAI:
+        return self.clients.get(vendor, self.clients["openai"])
+
+    def _get_semaphore(self, vendor: str) -> asyncio.Semaphore:
+        # Created lazily so that the semaphore is bound to the running loop
+        if vendor not in self._semaphores:
+            self._semaphores[vendor] = asyncio.Semaphore(self.max_concurrent_requests.get(vendor, 1))
+        return self._semaphores[vendor]
+
+    async def create(self, vendor: str, use_cache: bool = False, **kwargs):
+        # Caching is opt-in per call site, since it returns the same sample for the same context
+        cache_key = None
+        if use_cache and self.cache is not None:
+            cache_key = CompletionCache.key(vendor, kwargs)
+            response = await self.cache.get(cache_key)
+            if response is not None:
+                return response
+
+        async with self._get_semaphore(vendor):
+            response = await self.get_client(vendor).chat.completions.create(**kwargs)
+        log_usage(vendor, response.usage)
+        if cache_key is not None:
+            await self.cache.put(cache_key, response)
+        return response
+
+    async def stream(self, vendor: str, **kwargs):
+        # The concurrency slot is held until the stream is fully consumed
+        async with self._get_semaphore(vendor):
+            stream = await self.get_client(vendor).chat.completions.create(
+                stream=True,
+                stream_options={"include_usage": True},
+                **kwargs,
+            )
+            async for chunk in stream:
+                if chunk.usage is not None:
+                    log_usage(vendor, chunk.usage)
+                yield chunk
+
+def log_usage(vendor: str, usage):
+    if usage is None:
+        return
+    # DeepSeek reports prompt cache hits as a top-level usage field, OpenAI under prompt_tokens_details
+    cached_tokens = getattr(usage, "prompt_cache_hit_tokens", None)
+    if cached_tokens is None and getattr(usage, "prompt_tokens_details", None) is not None:
+        cached_tokens = usage.prompt_tokens_details.cached_tokens
+    print(
+        f"Usage ({vendor}): prompt_tokens={usage.prompt_tokens} cached_tokens={cached_tokens or 0} "
+        f"completion_tokens={usage.completion_tokens}"
+    )
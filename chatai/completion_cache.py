@@ -0,0 +1,134 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from openai.types.chat import ChatCompletion
+
+
+# Request parameters that do not change the completion
+NON_CONTENT_PARAMS = ("stream", "stream_options", "timeout", "extra_headers", "user")
+
+MODES = ("read_write", "record", "replay")
+
+# Expired and excess rows are deleted from the SQLite file once per this many writes
+PRUNE_EVERY_PUTS = 100
+
+class CompletionCacheMiss(Exception):
+    pass
+
+# Completions keyed by a canonical hash of (vendor, model, messages, sampling parameters).
+# Memory holds the most recently used entries up to max_entries; the optional SQLite file keeps them
+# across restarts, pruned on write to entries within the TTL and to the newest max_disk_entries. Modes:
+#   read_write - serve hits, store misses
+#   record     - always call the API and store the result
+#   replay     - serve hits only and raise CompletionCacheMiss otherwise, for offline runs
+class CompletionCache:
+    def __init__(
+            self,
+            max_entries: int,
+            ttl_seconds: Optional[float],
+            path: Optional[str] = None,
+            mode: str = "read_write",
+            max_disk_entries: Optional[int] = None,
+    ):
+        if mode not in MODES:
+            raise ValueError(f"Unknown completion cache mode {mode}, expected one of {MODES}")
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.path = path
+        self.mode = mode
+        self.max_disk_entries = max_disk_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, Tuple[float, str]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self._puts_since_prune = 0
+        if path is not None:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS completions (key TEXT PRIMARY KEY, created REAL, response TEXT)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS completions_created ON completions (created)")
+            self._db.commit()
+
+    @staticmethod
+    def key(vendor: str, request: Dict[str, Any]) -> str:
+        content = {k: v for k, v in request.items() if k not in NON_CONTENT_PARAMS}
+        canonical = json.dumps([vendor, content], sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    async def get(self, key: str) -> Optional[ChatCompletion]:
+        if self.mode == "record":
+            return None
+        response = self._get_memory(key)
+        if response is None and self._db is not None:
+            response = await asyncio.to_thread(self._get_disk, key)
+        if response is None:
+            self.misses += 1
+            if self.mode == "replay":
+                raise CompletionCacheMiss(key)
+            return None
+        self.hits += 1
+        return ChatCompletion.model_validate_json(response)
+
+    async def put(self, key: str, response: ChatCompletion):
+        serialized = response.model_dump_json()
+        created = time.time()
+        with self._lock:
+            self._entries[key] = (created, serialized)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        if self._db is not None:
+            await asyncio.to_thread(self._put_disk, key, created, serialized)
+
+    def _expired(self, created: float) -> bool:
+        # Recorded responses are replayed regardless of age
+        return self.ttl_seconds is not None and self.mode != "replay" and time.time() - created > self.ttl_seconds
+
+    def _get_memory(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if self._expired(entry[0]):
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def _get_disk(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._db.execute("SELECT created, response FROM completions WHERE key = ?", (key,)).fetchone()
+        if row is None or self._expired(row[0]):
+            return None
+        with self._lock:
+            self._entries[key] = (row[0], row[1])
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return row[1]
+
+    def _put_disk(self, key: str, created: float, serialized: str):
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO completions (key, created, response) VALUES (?, ?, ?)", (key, created, serialized))
+            self._puts_since_prune += 1
+            if self._puts_since_prune >= PRUNE_EVERY_PUTS:
+                self._prune_disk()
+                self._puts_since_prune = 0
+            self._db.commit()
+
+    def _prune_disk(self):
+        # Recordings (no TTL, no row limit) are kept in full for replay
+        if self.ttl_seconds is not None:
+            self._db.execute("DELETE FROM completions WHERE created < ?", (time.time() - self.ttl_seconds,))
+        if self.max_disk_entries is not None:
+            self._db.execute(
+                "DELETE FROM completions WHERE key NOT IN (SELECT key FROM completions ORDER BY created DESC LIMIT ?)",
+                (self.max_disk_entries,),
+            )
@@ -0,0 +1,193 @@
+import argparse
+import json
+import os
+import random
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from array import array
+from bisect import bisect_left
+from dataclasses import dataclass
+from itertools import accumulate
+from typing import Any, Dict, Iterator, List, Tuple
+
+from chatai.memory.plan import MESSAGE_OVERHEAD_TOKENS, get_encoding
+from chatai.dataset.telegram import ExportMessage, read_export
+
+
+# Tokens closing every sample in the chat format
+SAMPLE_OVERHEAD_TOKENS = 2
+
+@dataclass
+class DatasetBuildParams:
+    export_path: str
+    output_dir: str
+    model: str = "gpt-4o-mini"
+    system_prompt: str = "Продолжи цепочку сообщений в групповом чате наиболее подходящим образом."
+    max_context_tokens: int = 5000
+    max_context_messages: int = 30
+    merge_timeout_seconds: int = 60
+    sample_rate: float = 0.15
+    test_share: float = 0.05
+    seed: int = 0
+    # Samples are drawn per fixed-size shard of consecutive messages, so the output depends on
+    # the seed and shard size but not on the number of workers
+    shard_messages: int = 20_000
+    workers: int = 1
+
+@dataclass
+class SplitReport:
+    path: str
+    samples: int = 0
+    tokens: int = 0
+
+@dataclass
+class Shard:
+    split: str
+    index: int
+    start: int
+    end: int
+
+# Fine-tuning samples: every message is an assistant turn with a random number of preceding messages as context.
+# Each message is tokenized once; prefix sums of the counts give the context that fits the budget with a binary search.
+class ChatDataset:
+    def __init__(self, messages: List[ExportMessage], params: DatasetBuildParams):
+        self.messages = messages
+        self.params = params
+
+        encoding = get_encoding(params.model)
+        self.context_texts = [f"{m.user_name}: {m.text}" for m in messages]
+        context_counts = [len(t) + MESSAGE_OVERHEAD_TOKENS for t in encoding.encode_ordinary_batch(self.context_texts)]
+        self.reply_counts = array("q", (len(t) + MESSAGE_OVERHEAD_TOKENS for t in encoding.encode_ordinary_batch([m.text for m in messages])))
+        # context_prefix[i] is the number of tokens of messages [0, i)
+        self.context_prefix = array("q", accumulate(context_counts, initial=0))
+        self.system_tokens = len(encoding.encode_ordinary(params.system_prompt)) + MESSAGE_OVERHEAD_TOKENS
+
+    def __len__(self) -> int:
+        return len(self.messages)
+
+    def context_start(self, idx: int, max_messages: int) -> int:
+        # Earliest message such that messages [start, idx) fit into max_context_tokens
+        min_prefix = self.context_prefix[idx] - self.params.max_context_tokens
+        start = bisect_left(self.context_prefix, min_prefix, 0, idx)
+        return max(start, idx - max_messages)
+
+    def sample(self, idx: int, rng: random.Random) -> Tuple[Dict[str, Any], int]:
+        start = self.context_start(idx, rng.randint(1, self.params.max_context_messages))
+        messages = [{"role": "system", "content": self.params.system_prompt}]
+        # Oldest context message first, as in the conversation
+        messages.extend({"role": "user", "content": text} for text in self.context_texts[start:idx])
+        messages.append({"role": "assistant", "content": self.messages[idx].text, "weight": 1})
+        tokens = (
+            self.system_tokens
+            + self.context_prefix[idx] - self.context_prefix[start]
+            + self.reply_counts[idx]
+            + SAMPLE_OVERHEAD_TOKENS
+        )
+        return {"messages": messages}, tokens
+
+def write_split(dataset: ChatDataset, indices: range, path: str, rng: random.Random) -> SplitReport:
+    report = SplitReport(path)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        for idx in indices:
+            if rng.random() >= dataset.params.sample_rate:
+                continue
+            sample, tokens = dataset.sample(idx, rng)
+            f.write(json.dumps(sample, ensure_ascii=False) + "\n")
+            report.samples += 1
+            report.tokens += tokens
+    os.replace(tmp_path, path)
+    return report
+
+def plan_shards(num_messages: int, split_idx: int, shard_messages: int) -> List[Shard]:
+    # Shards are consecutive time ranges and never cross the train/test boundary
+    shards = []
+    for split, start, end in (("train", 0, split_idx), ("test", split_idx, num_messages)):
+        for index, shard_start in enumerate(range(start, end, shard_messages)):
+            shards.append(Shard(split, index, shard_start, min(shard_start + shard_messages, end)))
+    return shards
+
+def build_shard(params: DatasetBuildParams, messages: List[ExportMessage], offset: int, shard: Shard, path: str) -> SplitReport:
+    # messages start at global index offset and include the context preceding the shard
+    dataset = ChatDataset(messages, params)
+    rng = random.Random(f"{params.seed}-{shard.split}-{shard.index}")
+    return write_split(dataset, range(shard.start - offset, shard.end - offset), path, rng)
+
+def build_dataset(params: DatasetBuildParams) -> Tuple[SplitReport, SplitReport]:
+    print(f"Reading {params.export_path}...")
+    messages = read_export(params.export_path, params.merge_timeout_seconds)
+
+    # The test split is the most recent messages, so it does not leak into training contexts
+    split_idx = len(messages) - int(len(messages) * params.test_share)
+    shards = plan_shards(len(messages), split_idx, params.shard_messages)
+    shard_dir = os.path.join(params.output_dir, "shards")
+    os.makedirs(shard_dir, exist_ok=True)
+    print(f"Tokenizing and sampling {len(messages)} messages in {len(shards)} shards, {params.workers} workers...")
+
+    def shard_args(shard: Shard):
+        offset = max(shard.start - params.max_context_messages, 0)
+        path = os.path.join(shard_dir, f"{shard.split}_{shard.index:05d}.jsonl")
+        return params, messages[offset:shard.end], offset, shard, path
+
+    if params.workers > 1:
+        with ProcessPoolExecutor(params.workers) as executor:
+            futures = [executor.submit(build_shard, *shard_args(shard)) for shard in shards]
+            shard_reports = [future.result() for future in futures]
+    else:
+        shard_reports = [build_shard(*shard_args(shard)) for shard in shards]
+
+    train = _merge_shards(
+        [r for r, s in zip(shard_reports, shards) if s.split == "train"],
+        os.path.join(params.output_dir, "train.jsonl"),
+    )
+    test = _merge_shards(
+        [r for r, s in zip(shard_reports, shards) if s.split == "test"],
+        os.path.join(params.output_dir, "test.jsonl"),
+    )
+    shutil.rmtree(shard_dir)
+    print(f"Train: {train.samples} samples, {train.tokens} tokens")
+    print(f"Test: {test.samples} samples, {test.tokens} tokens")
+    return train, test
+
+def _merge_shards(shard_reports: List[SplitReport], path: str) -> SplitReport:
+    report = SplitReport(path)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as out:
+        for shard_report in shard_reports:
+            with open(shard_report.path, "rb") as f:
+                shutil.copyfileobj(f, out)
+            report.samples += shard_report.samples
+            report.tokens += shard_report.tokens
+    os.replace(tmp_path, path)
+    return report
+
+def iter_samples(path: str) -> Iterator[Dict[str, Any]]:
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build a fine-tuning dataset from a Telegram export")
+    parser.add_argument("export_path", type=str, help="Path to result.json")
+    parser.add_argument("output_dir", type=str)
+    parser.add_argument("--max-context-tokens", type=int, default=5000)
+    parser.add_argument("--max-context-messages", type=int, default=30)
+    parser.add_argument("--sample-rate", type=float, default=0.15)
+    parser.add_argument("--test-share", type=float, default=0.05)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Worker processes; check the speedup with `python -m chatai.debug.benchmark dataset_build` first",
+    )
+    args = parser.parse_args()
+    build_dataset(DatasetBuildParams(
+        args.export_path,
+        args.output_dir,
+        max_context_tokens=args.max_context_tokens,
+        max_context_messages=args.max_context_messages,
+        sample_rate=args.sample_rate,
+        test_share=args.test_share,
+        workers=args.workers,
+    ))
@@ -0,0 +1,112 @@
+import dataclasses
+import hashlib
+import json
+import os
+import threading
+from typing import Callable, Dict, Optional
+
+import chatai.dataset.builder
+import chatai.dataset.telegram
+from chatai.dataset.builder import DatasetBuildParams, build_dataset
+
+
+# Parameters that change where or how fast a dataset is built, but not its contents
+NON_CONTENT_PARAMS = ("export_path", "output_dir", "workers")
+
+# Experiments may share a cache from several threads; builds and manifest updates are serialized
+CACHE_LOCK = threading.RLock()
+
+# Built datasets under <root>/<key>/ and a manifest mapping each key to its splits and uploaded file ids.
+# The key covers the export file, the builder parameters and the builder source, so a rerun with nothing
+# changed neither rebuilds nor re-uploads.
+class DatasetCache:
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def key(self, params: DatasetBuildParams) -> str:
+        # The export is identified by its size and mtime; hashing a multi-GB file on every run would cost more than the check saves
+        stat = os.stat(params.export_path)
+        content_params = {k: v for k, v in dataclasses.asdict(params).items() if k not in NON_CONTENT_PARAMS}
+        h = hashlib.sha256()
+        h.update(json.dumps({
+            "export": [os.path.abspath(params.export_path), stat.st_size, stat.st_mtime_ns],
+            "params": content_params,
+        }, sort_keys=True).encode("utf-8"))
+        for module in (chatai.dataset.builder, chatai.dataset.telegram):
+            with open(module.__file__, "rb") as f:
+                h.update(f.read())
+        return h.hexdigest()[:16]
+
+    def get_or_build(self, params: DatasetBuildParams) -> Dict[str, Dict[str, ...]]:
+        with CACHE_LOCK:
+            return self._get_or_build(params)
+
+    def _get_or_build(self, params: DatasetBuildParams) -> Dict[str, Dict[str, ...]]:
+        key = self.key(params)
+        entry = self._read_manifest().get(key)
+        if entry is not None and all(os.path.exists(split["path"]) for split in entry.values()):
+            print(f"Dataset {key} is cached")
+            return entry
+
+        train, test = build_dataset(dataclasses.replace(params, output_dir=os.path.join(self.root, key)))
+        entry = {
+            "train": {"path": train.path, "samples": train.samples, "tokens": train.tokens, "file_id": None},
+            "test": {"path": test.path, "samples": test.samples, "tokens": test.tokens, "file_id": None},
+        }
+        self._update_manifest(key, entry)
+        return entry
+
+    def get_or_upload(
+            self,
+            params: DatasetBuildParams,
+            split: str,
+            upload: Callable[[str], str],
+            exists: Callable[[str], bool],
+    ) -> str:
+        with CACHE_LOCK:
+            return self._get_or_upload(params, split, upload, exists)
+
+    def _get_or_upload(
+            self,
+            params: DatasetBuildParams,
+            split: str,
+            upload: Callable[[str], str],
+            exists: Callable[[str], bool],
+    ) -> str:
+        entry = self._get_or_build(params)
+        file_id = entry[split]["file_id"]
+        if file_id is not None and exists(file_id):
+            print(f"Dataset {self.key(params)} ({split}) is already uploaded as {file_id}")
+            return file_id
+
+        file_id = upload(entry[split]["path"])
+        entry[split]["file_id"] = file_id
+        self._update_manifest(self.key(params), entry)
+        return file_id
+
+    def find_path(self, file_id: str) -> Optional[str]:
+        # Local copy of an uploaded split, if it was built by this cache
+        for entry in self._read_manifest().values():
+            for split in entry.values():
+                if split["file_id"] == file_id and os.path.exists(split["path"]):
+                    return split["path"]
+        return None
+
+    def _manifest_path(self) -> str:
+        return os.path.join(self.root, "manifest.json")
+
+    def _read_manifest(self) -> Dict[str, Dict[str, ...]]:
+        try:
+            with open(self._manifest_path(), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _update_manifest(self, key: str, entry: Dict[str, ...]):
+        manifest = self._read_manifest()
+        manifest[key] = entry
+        tmp_path = f"{self._manifest_path()}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp_path, self._manifest_path())
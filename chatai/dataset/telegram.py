@@ -0,0 +1,89 @@
+import json
+import re
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+
+READ_CHUNK_SIZE = 1 << 20
+
+MESSAGES_KEY = re.compile(r'"messages"\s*:\s*\[')
+DECODER = json.JSONDecoder()
+
+@dataclass
+class ExportMessage:
+    id: int
+    text: str
+    unixtime: int
+    user_id: str
+    user_name: str
+
+def iter_export_records(path: str, chunk_size: int = READ_CHUNK_SIZE) -> Iterator[Dict[str, Any]]:
+    # Telegram's result.json can be several GB, so records of the "messages" array are decoded
+    # one at a time from a sliding buffer instead of loading the whole document
+    with open(path, "r", encoding="utf-8") as f:
+        buffer = ""
+        while True:
+            match = MESSAGES_KEY.search(buffer)
+            if match is not None:
+                break
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return
+            # Keep a tail in case the key is split between chunks
+            buffer = buffer[-32:] + chunk
+        buffer = buffer[match.end():]
+        pos = 0
+        eof = False
+        while True:
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                pos += 1
+            if pos < len(buffer) and buffer[pos] == "]":
+                return
+            try:
+                if pos == len(buffer):
+                    raise ValueError("Buffer is empty")
+                record, end = DECODER.raw_decode(buffer, pos)
+            except ValueError:
+                if eof:
+                    raise ValueError(f"Truncated export: {path}")
+                chunk = f.read(chunk_size)
+                eof = not chunk
+                buffer = buffer[pos:] + chunk
+                pos = 0
+                continue
+            yield record
+            pos = end
+
+def parse_record(record: Dict[str, Any]) -> Optional[ExportMessage]:
+    # Only plain text messages; formatted ones come as a list of entities and are skipped
+    if record.get("type") != "message" or not isinstance(record.get("text"), str) or not record["text"]:
+        return None
+    return ExportMessage(
+        record["id"],
+        record["text"],
+        int(record["date_unixtime"]),
+        record["from_id"],
+        record["from"],
+    )
+
+def read_export(path: str, merge_timeout_seconds: int) -> List[ExportMessage]:
+    messages = [m for m in map(parse_record, iter_export_records(path)) if m is not None]
+    messages.sort(key=lambda m: m.unixtime)
+    return list(merge_consecutive_messages(messages, merge_timeout_seconds))
+
+def merge_consecutive_messages(messages: Iterable[ExportMessage], timeout_seconds: int) -> Iterator[ExportMessage]:
+    # Consecutive messages of the same user sent within timeout_seconds of each other become one
+    group: List[ExportMessage] = []
+    for message in messages:
+        if group and (message.user_id != group[0].user_id or message.unixtime - group[-1].unixtime > timeout_seconds):
+            yield _merge(group)
+            group = []
+        group.append(message)
+    if group:
+        yield _merge(group)
+
+def _merge(group: List[ExportMessage]) -> ExportMessage:
+    first = group[0]
+    if len(group) == 1:
+        return first
+    return ExportMessage(first.id, ". ".join(m.text for m in group), first.unixtime, first.user_id, first.user_name)
@@ -0,0 +1,630 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+import openai
+from openai import AsyncOpenAI
+from sqlalchemy import and_, create_engine, insert, select
+from sqlalchemy.orm import sessionmaker
+
+from chatai.completion import AsyncCompletionBackend
+from chatai.completion_cache import CompletionCache
+from chatai.dataset.builder import DatasetBuildParams, build_dataset
+from chatai.dataset.cache import DatasetCache
+from chatai.debug.local_files import LocalAsyncOpenAI, LocalOpenAI
+from chatai.memory.batch import (
+    iter_batch_output,
+    mark_consumed,
+    report_batch_errors,
+    submit_batch_task,
+    wait_for_batch_tasks,
+)
+from chatai.memory.plan import (
+    MESSAGE_OVERHEAD_TOKENS,
+    ExtractionWindow,
+    chunk_messages,
+    count_tokens,
+    pack_requests,
+    split_windows,
+    truncate_messages,
+)
+from chatai.prompt.prompt import Prompt, PromptCache
+from chatai.prompt.retrieval import FactRetriever, HashedEmbedder
+from chatai.sql.tables import BatchJob, ExtractionWatermark, Message, MessageImage
+from chatai.sql.writer import WriteBehindQueue
+
+
+def parse_arguments():
+    """Parse command-line arguments."""
+    parser = argparse.ArgumentParser(
+        description="Boogeyman benchmarks"
+    )
+
+    subparsers = parser.add_subparsers(dest="command", help="Available benchmarks")
+
+    load_test_parser = subparsers.add_parser(
+        "load_test", help="Concurrent chats against a local stub completion server"
+    )
+    load_test_parser.add_argument("--chats", type=int, default=16, help="Number of concurrent chats")
+    load_test_parser.add_argument("--latency", type=float, default=1.0, help="Stub completion latency, seconds")
+    load_test_parser.add_argument("--max-concurrent", type=int, default=16, help="Vendor concurrency limit")
+
+    prompt_build_parser = subparsers.add_parser(
+        "prompt_build", help="Per-message system prompt build latency, uncached vs cached"
+    )
+    prompt_build_parser.add_argument("--config-path", type=str, default="chatai/prompt.yaml")
+    prompt_build_parser.add_argument("--iterations", type=int, default=200)
+
+    range_read_parser = subparsers.add_parser(
+        "range_read", help="messages (chat_id, unixtime) range reads on a synthetic SQLite table"
+    )
+    range_read_parser.add_argument("--messages", type=int, default=1_000_000)
+    range_read_parser.add_argument("--chats", type=int, default=50)
+    range_read_parser.add_argument("--days", type=int, default=365)
+    range_read_parser.add_argument("--iterations", type=int, default=20)
+
+    retrieval_parser = subparsers.add_parser(
+        "retrieval", help="Per-message fact retrieval latency over synthetic memories"
+    )
+    retrieval_parser.add_argument("--config-path", type=str, default="chatai/prompt.yaml")
+    retrieval_parser.add_argument("--facts", type=int, default=10_000, help="Synthetic facts per prompt")
+    retrieval_parser.add_argument("--top-k", type=int, default=24)
+    retrieval_parser.add_argument("--dim", type=int, default=1024)
+    retrieval_parser.add_argument("--iterations", type=int, default=200)
+
+    dataset_build_parser = subparsers.add_parser(
+        "dataset_build", help="Dataset build time vs number of worker processes on a synthetic export"
+    )
+    dataset_build_parser.add_argument("--messages", type=int, default=500_000)
+    dataset_build_parser.add_argument("--sample-rate", type=float, default=0.5)
+    dataset_build_parser.add_argument("--max-workers", type=int, default=os.cpu_count())
+
+    dataset_cache_parser = subparsers.add_parser(
+        "dataset_cache", help="Repeated dataset build and upload against a local files API"
+    )
+    dataset_cache_parser.add_argument("--messages", type=int, default=100_000)
+    dataset_cache_parser.add_argument("--runs", type=int, default=3)
+
+    completion_cache_parser = subparsers.add_parser(
+        "completion_cache", help="Record completions from a stub server, then replay them with the server stopped"
+    )
+    completion_cache_parser.add_argument("--requests", type=int, default=200)
+    completion_cache_parser.add_argument("--distinct", type=int, default=20, help="Distinct prompts among the requests")
+    completion_cache_parser.add_argument("--latency", type=float, default=0.2, help="Stub completion latency, seconds")
+
+    batch_plan_parser = subparsers.add_parser(
+        "batch_plan", help="Memory extraction planning, batch packing and custom_id round-trip against a local Batch API"
+    )
+    batch_plan_parser.add_argument("--chats", type=int, default=5)
+    batch_plan_parser.add_argument("--messages", type=int, default=2000, help="Synthetic messages per chat")
+    batch_plan_parser.add_argument("--window-seconds", type=int, default=86400)
+    batch_plan_parser.add_argument("--max-input-tokens", type=int, default=2000)
+    batch_plan_parser.add_argument("--overlap-messages", type=int, default=5)
+    batch_plan_parser.add_argument("--max-requests", type=int, default=20, help="Lines per batch file")
+    batch_plan_parser.add_argument("--max-bytes", type=int, default=200_000, help="Bytes per batch file")
+    batch_plan_parser.add_argument("--fail-every", type=int, default=7, help="Every n-th request fails in the batch")
+
+    write_behind_parser = subparsers.add_parser(
+        "write_behind", help="Write-behind message queue against SQLite: batching, duplicates, failures, shutdown"
+    )
+    write_behind_parser.add_argument("--rows", type=int, default=1000)
+    write_behind_parser.add_argument("--max-batch-rows", type=int, default=100)
+    write_behind_parser.add_argument("--flush-interval-ms", type=int, default=200)
+
+    extraction_resume_parser = subparsers.add_parser(
+        "extraction_resume", help="An interrupted memory extraction rerun later against a local Batch API"
+    )
+    extraction_resume_parser.add_argument("--chats", type=int, default=3)
+    extraction_resume_parser.add_argument("--days", type=int, default=3)
+    extraction_resume_parser.add_argument("--rerun-delay-seconds", type=int, default=2 * 60 * 60)
+
+    return parser.parse_args()
+
+def _make_stub_handler(latency: float):
+    class StubCompletionHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            self.rfile.read(int(self.headers["Content-Length"]))
+            time.sleep(latency)
+            body = json.dumps({
+                "id": "stub",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": "stub",
+                "choices": [{
+                    "index": 0,
+                    "finish_reason": "stop",
+                    "message": {"role": "assistant", "content": "ok"},
+                }],
+            }).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return StubCompletionHandler
+
+def load_test(args: argparse.Namespace):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _make_stub_handler(args.latency))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    client = AsyncOpenAI(api_key="stub", base_url=f"http://127.0.0.1:{server.server_port}/v1")
+    backend = AsyncCompletionBackend({"stub": args.max_concurrent}, clients={"openai": client, "stub": client})
+
+    async def run():
+        async def chat(i: int):
+            await backend.create("stub", model="stub", messages=[{"role": "user", "content": str(i)}])
+
+        start = time.perf_counter()
+        await asyncio.gather(*(chat(i) for i in range(args.chats)))
+        return time.perf_counter() - start
+
+    try:
+        elapsed = asyncio.run(run())
+    finally:
+        server.shutdown()
+    print(f"{args.chats} concurrent chats, {args.latency:.2f}s per completion: {elapsed:.2f}s total "
+          f"({elapsed / args.latency:.1f} completion times)")
+
+def _time_per_call(fn, iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations
+
+def prompt_build(args: argparse.Namespace):
+    cache = PromptCache()
+    uncached = _time_per_call(lambda: Prompt(args.config_path).print(), args.iterations)
+    cached = _time_per_call(lambda: cache.get(args.config_path, stable=True), args.iterations)
+    print(f"uncached: {uncached * 1e3:.3f} ms/message")
+    print(f"cached:   {cached * 1e3:.3f} ms/message ({uncached / cached:.0f}x)")
+
+def range_read(args: argparse.Namespace):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        engine = create_engine(f"sqlite:///{os.path.join(tmp_dir, 'messages.db')}")
+        # Create the table without its indexes first to measure the baseline
+        Message.__table__.create(engine)
+        for index in Message.__table__.indexes:
+            index.drop(engine)
+
+        rng = random.Random(0)
+        start_time = 1_700_000_000
+        span = args.days * 24 * 60 * 60
+        print(f"Inserting {args.messages} messages...")
+        with engine.begin() as connection:
+            chunk_size = 10_000
+            for chunk_start in range(0, args.messages, chunk_size):
+                connection.execute(insert(Message), [
+                    {
+                        "id": i,
+                        "chat_id": rng.randrange(args.chats),
+                        "username": f"user{rng.randrange(20)}",
+                        "text": "x" * rng.randrange(10, 200),
+                        "unixtime": start_time + rng.randrange(span),
+                    }
+                    for i in range(chunk_start, min(chunk_start + chunk_size, args.messages))
+                ])
+
+        def read_day():
+            window_start = start_time + rng.randrange(span - 86400)
+            statement = select(Message.id, Message.text).where(
+                and_(
+                    Message.chat_id == rng.randrange(args.chats),
+                    Message.unixtime >= window_start,
+                    Message.unixtime < window_start + 86400,
+                )
+            )
+            with engine.connect() as connection:
+                connection.execute(statement).all()
+
+        without_index = _time_per_call(read_day, args.iterations)
+        for index in Message.__table__.indexes:
+            index.create(engine)
+        with_index = _time_per_call(read_day, args.iterations)
+        print(f"one-day range read without index: {without_index * 1e3:.2f} ms")
+        print(f"one-day range read with index:    {with_index * 1e3:.2f} ms ({without_index / with_index:.0f}x)")
+
+def retrieval(args: argparse.Namespace):
+    rng = random.Random(0)
+    words = [f"слово{i}" for i in range(2000)]
+    names = [character.name for character in Prompt(args.config_path).main_characters()] or ["Персонаж"]
+
+    def synthetic_fact() -> str:
+        return " ".join(rng.choice(words) for _ in range(rng.randrange(5, 20)))
+
+    retriever = FactRetriever(
+        HashedEmbedder(args.dim),
+        args.top_k,
+        0.2,
+        lambda: [(rng.choice(names), synthetic_fact()) for _ in range(args.facts)],
+    )
+    start = time.perf_counter()
+    retriever.render(args.config_path, synthetic_fact(), set())
+    print(f"index build: {(time.perf_counter() - start) * 1e3:.1f} ms for {args.facts} facts")
+
+    queries = ["\n".join(synthetic_fact() for _ in range(3)) for _ in range(args.iterations)]
+    query_iter = iter(queries)
+    per_message = _time_per_call(lambda: retriever.render(args.config_path, next(query_iter), {names[0]}), args.iterations)
+    cache = PromptCache()
+    full_prompt = _time_per_call(lambda: cache.get(args.config_path, stable=True), args.iterations)
+    print(f"retrieval:   {per_message * 1e3:.3f} ms/message")
+    print(f"full prompt: {full_prompt * 1e3:.3f} ms/message (cached)")
+
+def _write_synthetic_export(path: str, messages: int):
+    rng = random.Random(0)
+    words = [f"слово{i}" for i in range(5000)]
+    unixtime = 1_600_000_000
+    with open(path, "w", encoding="utf-8") as f:
+        f.write('{"name": "Benchmark", "type": "private_group", "id": 1, "messages": [\n')
+        for i in range(messages):
+            unixtime += rng.randrange(1, 600)
+            user = rng.randrange(10)
+            record = {
+                "id": i,
+                "type": "message",
+                "date_unixtime": str(unixtime),
+                "from": f"User {user}",
+                "from_id": f"user{user}",
+                "text": " ".join(rng.choice(words) for _ in range(rng.randrange(3, 60))),
+            }
+            f.write(("" if i == 0 else ",\n") + json.dumps(record, ensure_ascii=False))
+        f.write("\n]}\n")
+
+def dataset_build(args: argparse.Namespace):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        export_path = os.path.join(tmp_dir, "result.json")
+        print(f"Writing a synthetic export with {args.messages} messages...")
+        _write_synthetic_export(export_path, args.messages)
+
+        workers = 1
+        baseline = None
+        digests = set()
+        while workers <= args.max_workers:
+            output_dir = os.path.join(tmp_dir, f"workers_{workers}")
+            params = DatasetBuildParams(export_path, output_dir, sample_rate=args.sample_rate, workers=workers)
+            start = time.perf_counter()
+            train, test = build_dataset(params)
+            elapsed = time.perf_counter() - start
+            baseline = baseline or elapsed
+            with open(train.path, "rb") as f_train, open(test.path, "rb") as f_test:
+                digests.add(hashlib.sha256(f_train.read() + f_test.read()).hexdigest())
+            print(f"{workers} workers: {elapsed:.2f} s ({baseline / elapsed:.1f}x)")
+            workers *= 2
+        print(f"Outputs identical across worker counts: {len(digests) == 1}")
+
+def dataset_cache(args: argparse.Namespace):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        export_path = os.path.join(tmp_dir, "result.json")
+        _write_synthetic_export(export_path, args.messages)
+        client = LocalOpenAI(os.path.join(tmp_dir, "files"))
+        cache = DatasetCache(os.path.join(tmp_dir, "datasets"))
+        params = DatasetBuildParams(export_path, os.path.join(tmp_dir, "datasets"))
+
+        def upload(path: str) -> str:
+            with open(path, "rb") as f:
+                return client.files.create(file=f, purpose="fine-tune").id
+
+        def exists(file_id: str) -> bool:
+            try:
+                client.files.retrieve(file_id)
+            except openai.NotFoundError:
+                return False
+            return True
+
+        for run in range(args.runs):
+            if run == args.runs - 1:
+                # A changed export invalidates the cache
+                os.utime(export_path)
+            start = time.perf_counter()
+            file_id = cache.get_or_upload(params, "train", upload, exists)
+            elapsed = time.perf_counter() - start
+            print(f"run {run}: {elapsed * 1e3:.1f} ms, {file_id}, {client.files.uploads} uploads so far")
+
+def completion_cache(args: argparse.Namespace):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _make_stub_handler(args.latency))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    client = AsyncOpenAI(api_key="stub", base_url=f"http://127.0.0.1:{server.server_port}/v1", max_retries=0)
+
+    async def run(cache: Optional[CompletionCache]) -> float:
+        backend = AsyncCompletionBackend({"stub": 8}, clients={"openai": client, "stub": client}, cache=cache)
+        start = time.perf_counter()
+        for i in range(args.requests):
+            messages = [{"role": "user", "content": str(i % args.distinct)}]
+            await backend.create("stub", use_cache=True, model="stub", messages=messages, temperature=0.7)
+        return time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "completions.sqlite")
+        try:
+            uncached = asyncio.run(run(None))
+            serving_cache = CompletionCache(1000, 600, path)
+            cached = asyncio.run(run(serving_cache))
+        finally:
+            server.shutdown()
+            server.server_close()
+        # The server is gone; every response must come from the file
+        replay_cache = CompletionCache(1000, None, path, "replay")
+        replayed = asyncio.run(run(replay_cache))
+
+    print(f"{args.requests} requests, {args.distinct} distinct, {args.latency:.2f}s per completion")
+    print(f"no cache:   {uncached:.2f}s")
+    print(f"read_write: {cached:.2f}s ({serving_cache.hits} hits, {serving_cache.misses} misses)")
+    print(f"replay:     {replayed:.3f}s offline ({replay_cache.hits} hits)")
+
+def batch_plan(args: argparse.Namespace):
+    # Imported here, the extraction module needs a database at import and the other benchmarks don't
+    from chatai.memory.extract import make_request, parse_memory_line
+
+    model = "gpt-4o-mini"
+    rng = random.Random(0)
+    start_time = 1_700_000_000
+    days = 7
+
+    # Planning: windows, truncation of oversized messages and overlapping sub-requests
+    requests = []
+    window_by_custom_id = {}
+    names_by_chat = {}
+    for chat in range(args.chats):
+        # Group chat ids are negative, which must survive the custom_id round-trip
+        chat_id = -1_000_000_000_000 - chat
+        names_by_chat[chat_id] = [f"character{chat}"]
+        unixtimes = sorted(start_time + rng.randrange(days * 86400) for _ in range(args.messages))
+        texts = [" ".join(f"word{rng.randrange(1000)}" for _ in range(rng.randrange(1, 60))) for _ in unixtimes]
+        # A few messages over the whole request budget
+        for i in rng.sample(range(len(texts)), 3):
+            texts[i] = " ".join(f"word{j}" for j in range(args.max_input_tokens * 2))
+        for window in split_windows(chat_id, start_time, start_time + days * 86400, args.window_seconds):
+            messages = [
+                text for text, unixtime in zip(texts, unixtimes)
+                if window.start_unixtime_inclusive <= unixtime < window.end_unixtime_exclusive
+            ]
+            token_counts = [count_tokens(m, model) + MESSAGE_OVERHEAD_TOKENS for m in messages]
+            messages, token_counts = truncate_messages(messages, token_counts, args.max_input_tokens, model)
+            chunks = chunk_messages(messages, token_counts, args.max_input_tokens, args.overlap_messages)
+            assert all(sum(counts) <= args.max_input_tokens for _, counts in chunks), "sub-request over budget"
+            for part, (chunk, _) in enumerate(chunks):
+                custom_id = window.custom_id(part)
+                window_by_custom_id[custom_id] = window
+                requests.append(make_request(custom_id, names_by_chat[chat_id], chunk, "system", "memory", model, 256))
+    assert len(window_by_custom_id) == len(requests), "custom_id collision"
+
+    # Packing: every file within the line and size limits, requests kept in order
+    batches = pack_requests(requests, args.max_requests, args.max_bytes)
+    for batch in batches:
+        batch_bytes = sum(len(json.dumps(r).encode("utf-8")) + 1 for r in batch)
+        assert len(batch) <= args.max_requests and batch_bytes <= args.max_bytes, "batch file over the limits"
+    assert [r for batch in batches for r in batch] == requests, "packing reordered requests"
+    print(f"{len(requests)} requests from {args.chats} chats in {len(batches)} batch files")
+
+    def respond(custom_id: str, body: dict):
+        if int(hashlib.sha256(custom_id.encode()).hexdigest(), 16) % args.fail_every == 0:
+            return 500, {"error": {"message": "synthetic failure"}}
+        character_name = body["response_format"]["json_schema"]["schema"]["properties"]["facts"]["items"][
+            "properties"]["character_name"]["enum"][0]
+        facts = {"facts": [{"character_name": character_name, "fact": custom_id, "interest_score": 0.5}]}
+        return 200, {"choices": [{"message": {"role": "assistant", "content": json.dumps(facts)}}]}
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        client = LocalOpenAI(
+            os.path.join(tmp_dir, "files"),
+            respond,
+            max_requests=args.max_requests,
+            max_bytes=args.max_bytes,
+        )
+        engine = create_engine(f"sqlite:///{os.path.join(tmp_dir, 'batches.db')}")
+        BatchJob.__table__.create(engine)
+        session = sessionmaker(bind=engine)()
+        try:
+            jobs = [submit_batch_task(session, client, batch, f"batch_plan_{i}") for i, batch in enumerate(batches)]
+            asyncio.run(wait_for_batch_tasks(session, LocalAsyncOpenAI(client), jobs))
+            assert all(job.status == "completed" for job in jobs), "a batch file was rejected"
+            # Resubmitting the same files resumes the ledger entries instead of creating new batches
+            resumed = [submit_batch_task(session, client, batch, f"batch_plan_{i}") for i, batch in enumerate(batches)]
+            assert [job.batch_id for job in resumed] == [job.batch_id for job in jobs], "resubmission created new batches"
+
+            # Round-trip: every fact comes back attributed to the window that produced its request
+            answered = set()
+            errors = 0
+            for job in jobs:
+                errors += report_batch_errors(client, job)
+                if job.output_file_id is None:
+                    continue
+                for line in iter_batch_output(client, job.output_file_id):
+                    for row in parse_memory_line(line, names_by_chat):
+                        window = window_by_custom_id[row["fact"]]
+                        assert ExtractionWindow(row["chat_id"], row["start_unixtime"], row["end_unixtime"]) == window
+                        answered.add(row["fact"])
+        finally:
+            session.close()
+    assert len(answered) + errors == len(requests), "requests lost between submission and output"
+    print(f"{len(answered)} answered, {errors} failed, all attributed to their planned windows")
+
+def write_behind(args: argparse.Namespace):
+    def message_row(i: int, text: str) -> dict:
+        return dict(id=i, chat_id=1, username="user", text=text, unixtime=1_700_000_000 + i, reply_to_message_id=None)
+
+    async def wait_for(condition, timeout: float) -> float:
+        start = time.perf_counter()
+        while not condition():
+            assert time.perf_counter() - start < timeout, "timed out"
+            await asyncio.sleep(0.001)
+        return time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        engine = create_engine(f"sqlite:///{os.path.join(tmp_dir, 'messages.db')}")
+        Message.__table__.create(engine)
+        MessageImage.__table__.create(engine)
+
+        def stored() -> dict:
+            with engine.connect() as connection:
+                return dict(connection.execute(select(Message.id, Message.text)).all())
+
+        async def run():
+            # Row-count batching: with an interval far away, full batches are written right away
+            writer = WriteBehindQueue(engine, 60_000, args.max_batch_rows)
+            writer.start()
+            for i in range(args.rows):
+                writer.put(Message.__table__, message_row(i, "first"))
+            assert writer.queue_depth == args.rows, "rows written on the hot path"
+            print(f"queue depth after {args.rows} puts: {writer.metrics()['queue_depth']}")
+            full_rows = args.rows // args.max_batch_rows * args.max_batch_rows
+            elapsed = await wait_for(lambda: writer.written_rows == full_rows, 10)
+            print(f"{full_rows} rows in {writer.flushes} full batches after {elapsed * 1e3:.0f} ms")
+            assert writer.flushes == args.rows // args.max_batch_rows
+            # The remainder waits for the interval, then close() flushes it
+            await asyncio.sleep(0.05)
+            assert writer.written_rows == full_rows, "partial batch flushed before its interval"
+            await writer.close()
+            assert writer.written_rows == args.rows and len(stored()) == args.rows, "close() lost rows"
+            print(f"close(): {writer.metrics()}")
+
+            # Time batching: a partial batch is written once the interval passes
+            writer = WriteBehindQueue(engine, args.flush_interval_ms, args.rows * 10)
+            writer.start()
+            for i in range(args.rows, args.rows + 10):
+                writer.put(Message.__table__, message_row(i, "first"))
+            elapsed = await wait_for(lambda: writer.written_rows == 10, 10)
+            print(f"10 rows in {writer.flushes} flush after {elapsed * 1e3:.0f} ms ({args.flush_interval_ms} ms interval)")
+            assert writer.flushes == 1 and elapsed >= args.flush_interval_ms / 1000 * 0.9
+
+            # Duplicates, across batches and within one, keep the stored row
+            for i in range(5):
+                writer.put(Message.__table__, message_row(i, "second"))
+                writer.put(Message.__table__, message_row(i, "third"))
+            writer.put(Message.__table__, message_row(args.rows + 10, "new"))
+            writer.put(Message.__table__, message_row(args.rows + 10, "new duplicate"))
+            await wait_for(lambda: writer.flushes == 2, 10)
+            rows = stored()
+            assert len(rows) == args.rows + 11 and all(rows[i] == "first" for i in range(5)), "duplicates overwrote rows"
+            assert rows[args.rows + 10] == "new" and writer.failed_rows == 0
+            print("duplicates ignored")
+
+            # A failing batch is counted and the writer keeps going
+            writer.put(MessageImage.__table__, dict(message_id=0, data=None))
+            await wait_for(lambda: writer.flushes == 3, 10)
+            writer.put(Message.__table__, message_row(args.rows + 11, "after failure"))
+            await writer.close()
+            assert writer.failed_rows == 1 and stored()[args.rows + 11] == "after failure", "writer stopped on error"
+            print(f"after a failed batch: {writer.metrics()}")
+
+        asyncio.run(run())
+
+def extraction_resume(args: argparse.Namespace):
+    from chatai.memory.extract import ChatInfo, set_watermark, submit_extraction
+    from chatai.memory.plan import PackingParams
+
+    rng = random.Random(0)
+    window_seconds = 86400
+    start_time = 1_700_000_000
+    end_time = start_time + args.days * window_seconds
+    chats = [ChatInfo(-1_000_000_000_000 - chat, [f"character{chat}"]) for chat in range(args.chats)]
+    packing_params = PackingParams(max_input_tokens=2000, max_block_tokens=500, overlap_messages=5)
+
+    def respond(custom_id: str, body: dict):
+        facts = {"facts": []}
+        return 200, {"choices": [{"message": {"role": "assistant", "content": json.dumps(facts)}}]}
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        client = LocalOpenAI(os.path.join(tmp_dir, "files"), respond, polls_until_done=sys.maxsize)
+        engine = create_engine(f"sqlite:///{os.path.join(tmp_dir, 'extraction.db')}")
+        for table in (Message, MessageImage, BatchJob, ExtractionWatermark):
+            table.__table__.create(engine)
+        with engine.begin() as connection:
+            connection.execute(insert(Message), [
+                {
+                    "id": i,
+                    "chat_id": chats[i % args.chats].id,
+                    "username": f"user{rng.randrange(5)}",
+                    "text": " ".join(f"word{rng.randrange(1000)}" for _ in range(rng.randrange(1, 40))),
+                    "unixtime": start_time + rng.randrange(args.days * window_seconds + args.rerun_delay_seconds),
+                }
+                for i in range(args.chats * args.days * 100)
+            ])
+        session = sessionmaker(bind=engine)()
+
+        def run(end: int):
+            return submit_extraction(
+                session, client, chats, end, window_seconds, "gpt-4o-mini", 256, packing_params, "system", "memory",
+            )
+
+        def batch_windows(batch_ids) -> set:
+            windows = set()
+            for batch_id in batch_ids:
+                input_file_id = next(
+                    job.input_file_id for job in session.query(BatchJob) if job.batch_id == batch_id
+                )
+                for line in client.files.read(input_file_id).decode("utf-8").splitlines():
+                    windows.add(ExtractionWindow.from_custom_id(json.loads(line)["custom_id"]))
+            return windows
+
+        try:
+            for chat in chats:
+                set_watermark(session, chat.id, start_time)
+            # The first run submits its batches and is interrupted while they are running
+            jobs, end, _ = run(end_time)
+            first_batches = set(client.batches.batches)
+            print(f"first run: {len(first_batches)} batches up to {end}")
+
+            # A rerun later resumes them and plans nothing past the interrupted run's end
+            jobs, end, _ = run(end_time + args.rerun_delay_seconds)
+            assert set(client.batches.batches) == first_batches, "the rerun submitted windows a second time"
+            assert end == end_time and {job.batch_id for job in jobs} == first_batches
+            print(f"rerun {args.rerun_delay_seconds} s later: resumed {len(jobs)} batches up to {end}, none submitted")
+
+            # Once they are consumed, the next run starts from the advanced watermark
+            client.batches.polls_until_done = 0
+            asyncio.run(wait_for_batch_tasks(session, LocalAsyncOpenAI(client), jobs))
+            for job in jobs:
+                mark_consumed(session, job)
+            for chat in chats:
+                set_watermark(session, chat.id, end)
+            jobs, end, _ = run(end_time + args.rerun_delay_seconds)
+            new_batches = set(client.batches.batches) - first_batches
+            new_windows = batch_windows(new_batches)
+            assert new_windows and all(w.start_unixtime_inclusive >= end_time for w in new_windows)
+            assert not new_windows & batch_windows(first_batches), "a window was paid for twice"
+            print(f"next run: {len(new_batches)} batches for {len(new_windows)} new windows only")
+        finally:
+            session.close()
+
+def main():
+    args = parse_arguments()
+
+    if args.command == "load_test":
+        load_test(args)
+    elif args.command == "prompt_build":
+        prompt_build(args)
+    elif args.command == "range_read":
+        range_read(args)
+    elif args.command == "retrieval":
+        retrieval(args)
+    elif args.command == "dataset_build":
+        dataset_build(args)
+    elif args.command == "dataset_cache":
+        dataset_cache(args)
+    elif args.command == "completion_cache":
+        completion_cache(args)
+    elif args.command == "batch_plan":
+        batch_plan(args)
+    elif args.command == "write_behind":
+        write_behind(args)
+    elif args.command == "extraction_resume":
+        extraction_resume(args)
+    else:
+        print("Error: No valid command provided.", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
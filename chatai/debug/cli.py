@@ -5,6 +5,7 @@ from scp import SCPClient
 
 
 from chatai.prompt.prompt import Prompt
+from chatai.prompt.versions import PromptVersions
 
 
 def parse_arguments():
@@ -53,6 +54,33 @@ def parse_arguments():
         default="35.214.126.200",
     )
 
+    rollback_prompt_parser = subparsers.add_parser(
+        "rollback_prompt", help="Atomically switch the live prompt to a published version"
+    )
+    rollback_prompt_parser.add_argument(
+        "--version",
+        type=str,
+        help="Version hash; by default, the version active before the current one (repeat to go further back)",
+        default=None,
+    )
+    rollback_prompt_parser.add_argument(
+        "--versions-path",
+        type=str,
+        help="Directory with prompt snapshots",
+        default="/home/bsharchilev/chatai/chatai/prompt_versions",
+    )
+    rollback_prompt_parser.add_argument(
+        "--config-path",
+        type=str,
+        help="Live prompt config",
+        default="/home/bsharchilev/chatai/chatai/prompt.yaml",
+    )
+    rollback_prompt_parser.add_argument(
+        "--list",
+        action="store_true",
+        help="Only list the version stack, oldest first",
+    )
+
     return parser.parse_args()
 
 def show_prompt(args: argparse.Namespace):
@@ -68,6 +96,16 @@ def copy_prompt(args: argparse.Namespace):
             scp.get(args.remote_path, args.local_path)
     ssh.close()
 
+def rollback_prompt(args: argparse.Namespace):
+    text_path = args.config_path[:-len(".yaml")] + ".txt"
+    versions = PromptVersions(args.versions_path, args.config_path, text_path)
+    if args.list:
+        current = versions.current()
+        for version in versions.history():
+            print(f"{version}{' (current)' if version == current else ''}")
+        return
+    versions.rollback(args.version)
+
 def _create_ssh_client(hostname: str, port: int) -> paramiko.SSHClient:
     ssh = paramiko.SSHClient()
     ssh.load_system_host_keys()
@@ -81,8 +119,10 @@ def main():
     # Execute the appropriate function based on the command
     if args.command == "show_prompt":
         show_prompt(args)
-    if args.command == "copy_prompt":
+    elif args.command == "copy_prompt":
         copy_prompt(args)
+    elif args.command == "rollback_prompt":
+        rollback_prompt(args)
     else:
         print("Error: No valid command provided.", file=sys.stderr)
         sys.exit(1)
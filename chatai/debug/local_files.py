@@ -0,0 +1,155 @@
+import contextlib
+import hashlib
+import json
+import os
+import time
+import types
+from typing import Any, Callable, Dict, IO, Optional, Tuple
+
+import httpx
+import openai
+
+from chatai.memory.plan import MAX_BATCH_FILE_BYTES, MAX_BATCH_REQUESTS
+
+
+# Stand-in for the OpenAI files API backed by a local directory, for running experiments offline
+class LocalFiles:
+    def __init__(self, root: str):
+        self.root = root
+        self.uploads = 0
+        os.makedirs(root, exist_ok=True)
+        self.with_streaming_response = types.SimpleNamespace(content=self._streaming_content)
+
+    def create(self, file: IO[bytes] | Tuple[str, bytes], purpose: str):
+        content = file[1] if isinstance(file, tuple) else file.read()
+        file_id = f"file-local-{hashlib.sha256(content).hexdigest()[:24]}"
+        self.write(file_id, content)
+        self.uploads += 1
+        return self._file_object(file_id, purpose)
+
+    def retrieve(self, file_id: str):
+        self._check_exists(file_id)
+        return self._file_object(file_id, "fine-tune")
+
+    def content(self, file_id: str):
+        return types.SimpleNamespace(text=self.read(file_id).decode("utf-8"))
+
+    def delete(self, file_id: str):
+        os.remove(os.path.join(self.root, file_id))
+        return types.SimpleNamespace(id=file_id, deleted=True)
+
+    def read(self, file_id: str) -> bytes:
+        self._check_exists(file_id)
+        with open(os.path.join(self.root, file_id), "rb") as f:
+            return f.read()
+
+    def write(self, file_id: str, content: bytes):
+        with open(os.path.join(self.root, file_id), "wb") as f:
+            f.write(content)
+
+    @contextlib.contextmanager
+    def _streaming_content(self, file_id: str):
+        lines = self.read(file_id).decode("utf-8").splitlines()
+        yield types.SimpleNamespace(iter_lines=lambda: iter(lines))
+
+    def _check_exists(self, file_id: Optional[str]):
+        if file_id is None or not os.path.exists(os.path.join(self.root, file_id)):
+            request = httpx.Request("GET", f"local://files/{file_id}")
+            raise openai.NotFoundError(f"No such File object: {file_id}", response=httpx.Response(404, request=request), body=None)
+
+    def _file_object(self, file_id: str, purpose: str):
+        path = os.path.join(self.root, file_id)
+        return types.SimpleNamespace(
+            id=file_id,
+            bytes=os.path.getsize(path),
+            created_at=int(os.path.getmtime(path)),
+            purpose=purpose,
+            status="processed",
+        )
+
+# Stand-in for the Batch API. Requests are answered by `respond(custom_id, body) -> (status_code, body)` when the
+# batch is created, and the batch reports "in_progress" for `polls_until_done` retrievals before completing.
+# Input files over the per-file limits fail validation, as they would upstream.
+class LocalBatches:
+    def __init__(
+            self,
+            files: LocalFiles,
+            respond: Callable[[str, Dict[str, Any]], Tuple[int, Dict[str, Any]]],
+            polls_until_done: int = 0,
+            max_requests: int = MAX_BATCH_REQUESTS,
+            max_bytes: int = MAX_BATCH_FILE_BYTES,
+    ):
+        self.files = files
+        self.respond = respond
+        self.polls_until_done = polls_until_done
+        self.max_requests = max_requests
+        self.max_bytes = max_bytes
+        self.batches: Dict[str, Dict[str, Any]] = {}
+
+    def create(self, input_file_id: str, endpoint: str, completion_window: str, metadata: Optional[Dict[str, str]] = None):
+        content = self.files.read(input_file_id)
+        batch_id = f"batch-local-{len(self.batches)}"
+        lines = content.decode("utf-8").splitlines()
+        batch = {"id": batch_id, "polls": 0, "output_file_id": None, "error_file_id": None, "total": len(lines)}
+        if len(lines) > self.max_requests or len(content) > self.max_bytes:
+            batch["status"] = "failed"
+        else:
+            batch["status"] = "in_progress"
+            outputs, errors = [], []
+            for line in lines:
+                request = json.loads(line)
+                status_code, body = self.respond(request["custom_id"], request["body"])
+                record = {"custom_id": request["custom_id"], "response": {"status_code": status_code, "body": body}, "error": None}
+                (outputs if status_code == 200 else errors).append(json.dumps(record, ensure_ascii=False))
+            batch["completed"], batch["failed"] = len(outputs), len(errors)
+            if outputs:
+                batch["output_file_id"] = f"{batch_id}-output"
+                self.files.write(batch["output_file_id"], ("\n".join(outputs) + "\n").encode("utf-8"))
+            if errors:
+                batch["error_file_id"] = f"{batch_id}-errors"
+                self.files.write(batch["error_file_id"], ("\n".join(errors) + "\n").encode("utf-8"))
+        self.batches[batch_id] = batch
+        return self._batch_object(batch, "validating")
+
+    def retrieve(self, batch_id: str):
+        batch = self.batches[batch_id]
+        batch["polls"] += 1
+        if batch["status"] == "in_progress" and batch["polls"] > self.polls_until_done:
+            batch["status"] = "completed"
+        return self._batch_object(batch, batch["status"])
+
+    def _batch_object(self, batch: Dict[str, Any], status: str):
+        done = status == "completed"
+        return types.SimpleNamespace(
+            id=batch["id"],
+            status=status,
+            created_at=int(time.time()),
+            output_file_id=batch["output_file_id"] if done else None,
+            error_file_id=batch["error_file_id"] if done else None,
+            request_counts=types.SimpleNamespace(
+                total=batch["total"],
+                completed=batch.get("completed", 0) if done else 0,
+                failed=batch.get("failed", 0) if done else 0,
+            ),
+        )
+
+class LocalOpenAI:
+    def __init__(
+            self,
+            root: str,
+            respond: Optional[Callable[[str, Dict[str, Any]], Tuple[int, Dict[str, Any]]]] = None,
+            **batch_options,
+    ):
+        self.files = LocalFiles(root)
+        self.batches = LocalBatches(
+            self.files,
+            respond or (lambda custom_id, body: (404, {"error": "no responder"})),
+            **batch_options,
+        )
+
+class LocalAsyncOpenAI:
+    # Async view of the same local state, for pollers that take an AsyncOpenAI client
+    def __init__(self, client: LocalOpenAI):
+        async def retrieve(batch_id: str):
+            return client.batches.retrieve(batch_id)
+        self.batches = types.SimpleNamespace(retrieve=retrieve)
@@ -1,9 +1,20 @@
+import asyncio
+import os
 import wandb
-import time
 import openai
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import Optional, Tuple, Dict, List
 
+from chatai.completion import AsyncCompletionBackend
+from chatai.completion_cache import CompletionCache
+from chatai.dataset.builder import DatasetBuildParams, iter_samples
+from chatai.dataset.cache import DatasetCache
+from chatai.fine_tune import FineTuneTracker
+from chatai.validation import PredictionRow, ValidationParams, ValidationRunner, BatchValidationRunner
+
+
+# In-memory part of the prediction cache; everything recorded is kept on disk
+MAX_CACHED_PREDICTIONS = 10_000
 
 @dataclass
 class DatasetParams:
@@ -16,46 +27,108 @@ class ExperimentConfig:
     experiment_id: str
     train_dataset: DatasetParams
     test_dataset: DatasetParams
+    validation: ValidationParams = field(default_factory=ValidationParams)
+    # train_dataset and test_dataset are built as the "train" and "test" splits of this
+    dataset: Optional[DatasetBuildParams] = None
+
+    def __post_init__(self):
+        train_id, test_id = self.train_dataset.existing_dataset_id, self.test_dataset.existing_dataset_id
+        if train_id is not None and train_id == test_id:
+            raise ValueError(f"{self.experiment_id}: train and test datasets are the same file {train_id}")
 
 
 class OpenAIExperiments:
-    def __init__(self, openai_client: openai.OpenAI, wandb_api_key: str):
+    def __init__(self, openai_client: openai.OpenAI, async_openai_client: openai.AsyncOpenAI, wandb_api_key: str):
         self._openai_client = openai_client
+        self._async_openai_client = async_openai_client
         wandb.login(key=wandb_api_key)
 
     def run_experiment(self, config: ExperimentConfig):
-        # query if datasets already exist, otherwise create them with given parameters
-        # if needed - upload
-        train_dataset_id = self._retrieve_or_generate_dataset(config.train_dataset, config)
+        self.run_experiments([config])
 
-        # submit fine-tuning job, use wandb native integration
-        fine_tune_job_id = self._submit_fine_tune(train_dataset_id, config)
+    def run_experiments(self, configs: List[ExperimentConfig]):
+        # Experiments run side by side; each one moves on to predictions as soon as its own job is done
+        asyncio.run(self._run_experiments(configs))
 
-        # periodically poll status, and log train/test metrics
-        result = self._wait_for_fine_tune(fine_tune_job_id)
+    async def _run_experiments(self, configs: List[ExperimentConfig]):
+        results = await asyncio.gather(*(self._run_experiment(config) for config in configs), return_exceptions=True)
+        for config, result in zip(configs, results):
+            if isinstance(result, Exception):
+                print(f"Experiment {config.experiment_id} failed: {result!r}")
 
+    async def _run_experiment(self, config: ExperimentConfig):
+        # query if datasets already exist, otherwise create them with given parameters
+        # if needed - upload
+        train_dataset_id = await asyncio.to_thread(self._retrieve_or_generate_dataset, config.train_dataset, "train", config)
 
-        # once fine tune is done - query predictions on the test dataset:
-          # take each conversation, do it step-by-step:
-          # include a system message in each
-          # include all user and assistant messages up to this point
-          # generate new response, upload to W&B
-        val_dataset = self._retrieve_or_generate_dataset(config.test_dataset, config)
-        self._generate_test_predictions(val_dataset, result.fine_tuned_model, config.project_id, config.experiment_id)
+        # submit fine-tuning job, use wandb native integration
+        fine_tune_job_id = await asyncio.to_thread(self._submit_fine_tune, train_dataset_id, config)
 
-    def _retrieve_or_generate_dataset(self, dataset_params: DatasetParams, config: ExperimentConfig) -> str:
+        # One W&B run per experiment, so concurrent experiments do not log into each other
+        run = wandb.init(project=config.project_id, name=config.experiment_id, reinit="create_new")
+        try:
+            # follow the job's events, and log train/val metrics per step
+            result = await self._wait_for_fine_tune(fine_tune_job_id, run)
+            if result.status != "succeeded":
+                print(f"Fine-tuning job {fine_tune_job_id} {result.status}, skipping predictions")
+                return
+
+            # once fine tune is done - query predictions on the test dataset:
+              # take each conversation, do it step-by-step:
+              # include a system message in each
+              # include all user and assistant messages up to this point
+              # generate new response, upload to W&B
+            # Predictions are made from a local copy of the test split
+            val_path = await asyncio.to_thread(self._create_and_save_dataset, config.test_dataset, "test", config)
+            val_dataset = list(iter_samples(val_path))
+            await self._generate_test_predictions(val_dataset, result.fine_tuned_model, config.experiment_id, config.validation, run)
+        finally:
+            run.finish()
+
+    def _retrieve_or_generate_dataset(self, dataset_params: DatasetParams, split: str, config: ExperimentConfig) -> str:
         if dataset_params.existing_dataset_id is not None and self._dataset_exists(dataset_params.existing_dataset_id):
-            dataset_id = dataset_params.existing_dataset_id
-        else:
-            dataset_path = self._create_and_save_dataset(config)
-            dataset_id = self._upload_dataset(dataset_path)
-        return dataset_id
+            return dataset_params.existing_dataset_id
+        if config.dataset is None:
+            raise ValueError(f"No existing {split} dataset and no dataset build parameters")
+        # Rebuilt and re-uploaded only when the export, the build parameters or the builder change
+        return DatasetCache(config.dataset.output_dir).get_or_upload(
+            config.dataset,
+            split,
+            self._upload_dataset,
+            self._dataset_exists,
+        )
 
     def _dataset_exists(self, dataset_id: str) -> bool:
-        pass
-
-    def _create_and_save_dataset(self, config: ExperimentConfig) -> str:
-        pass
+        try:
+            file = self._openai_client.files.retrieve(dataset_id)
+        except openai.NotFoundError:
+            return False
+        return file.status != "error"
+
+    def _create_and_save_dataset(self, dataset_params: DatasetParams, split: str, config: ExperimentConfig) -> str:
+        if dataset_params.existing_dataset_id is not None:
+            return self._local_dataset_path(dataset_params.existing_dataset_id, config)
+        if config.dataset is None:
+            raise ValueError(f"No existing {split} dataset and no dataset build parameters")
+        return DatasetCache(config.dataset.output_dir).get_or_build(config.dataset)[split]["path"]
+
+    def _local_dataset_path(self, dataset_id: str, config: ExperimentConfig) -> str:
+        # Splits built by the dataset cache are found through its manifest, anything else is downloaded
+        if config.dataset is not None:
+            path = DatasetCache(config.dataset.output_dir).find_path(dataset_id)
+            if path is not None:
+                return path
+        path = os.path.join(config.validation.checkpoint_dir, f"{dataset_id}.jsonl")
+        if not os.path.exists(path):
+            os.makedirs(config.validation.checkpoint_dir, exist_ok=True)
+            try:
+                content = self._openai_client.files.content(dataset_id)
+            except openai.APIError as e:
+                raise ValueError(f"Dataset {dataset_id} has no local copy and cannot be downloaded: {e}")
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            content.write_to_file(tmp_path)
+            os.replace(tmp_path, path)
+        return path
 
     def _upload_dataset(self, dataset_path: str) -> str:
         with open(dataset_path, 'rb') as file_to_upload:
@@ -81,39 +154,46 @@ class OpenAIExperiments:
             }],
         )
 
-        fine_tune_id = response['id']
+        fine_tune_id = response.id
         print(f"Fine-tuning job submitted: {fine_tune_id}")
 
         return fine_tune_id
 
-    def _wait_for_fine_tune(self, fine_tune_id: str):
-        while True:
-            # Retrieve the fine-tune status
-            status = self._openai_client.fine_tuning.jobs.retrieve(fine_tune_id)
-            # Log current status to W&B
-            wandb.log({
-                "status": status['status'],
-            })
-
-            print(f"Fine-tuning status: {status['status']}")
-
-            if status['status'] in ["succeeded", "failed"]:
-                break
-
-            time.sleep(1 * 60 * 60)
+    async def _wait_for_fine_tune(self, fine_tune_id: str, run):
+        def log_metrics(step: int, metrics: Dict[str, float]):
+            run.log(metrics, step=step)
 
-        return status
+        return await FineTuneTracker(self._async_openai_client, fine_tune_id, log_metrics).wait()
 
-    def _generate_test_predictions(
+    async def _generate_test_predictions(
             self,
             validation_dataset: List[Dict[str, ...]],
             model_id: str,
-            wandb_project_id: str,
             wandb_experiment_id: str,
+            params: ValidationParams,
+            run,
     ):
         print("Generating predictions for validation dataset")
 
-        run = wandb.init(project=wandb_project_id, name=wandb_experiment_id)
+        if params.prediction_mode == "batch":
+            rows = await self._generate_batch_predictions(validation_dataset, model_id, wandb_experiment_id, params)
+        else:
+            cache = None
+            if params.cache_mode is not None:
+                cache = CompletionCache(MAX_CACHED_PREDICTIONS, None, params.cache_path, params.cache_mode)
+            backend = AsyncCompletionBackend(
+                {"openai": params.max_concurrent_requests},
+                clients={"openai": self._async_openai_client},
+                cache=cache,
+            )
+            runner = ValidationRunner(
+                backend,
+                "openai",
+                model_id,
+                params,
+                os.path.join(params.checkpoint_dir, f"{wandb_experiment_id}.jsonl"),
+            )
+            rows = await runner.run(validation_dataset)
 
         table = wandb.Table(columns=[
             "Conversation ID",
@@ -122,41 +202,31 @@ class OpenAIExperiments:
             "Content (original)",
             "Content (generated)"
         ])
+        for row in rows:
+            table.add_data(row.conversation_idx, row.message_idx, row.role, row.original, row.generated)
+        # Logged once, re-logging a growing table re-uploads all of it
+        run.log({"Validation predictions": table})
 
+    async def _generate_batch_predictions(
+            self,
+            validation_dataset: List[Dict[str, ...]],
+            model_id: str,
+            wandb_experiment_id: str,
+            params: ValidationParams,
+    ) -> List[PredictionRow]:
+        # Imported here, experiments without batch predictions run without a database
+        from chatai.sql import Session
+
+        session = Session()
         try:
-            predictions = []
-
-            # Retrieve the fine-tuned model ID
-            for conversation_idx, conversation in enumerate(validation_dataset):
-                original_messages = conversation["messages"]
-                generated_completions = []
-
-                for message_idx, message in enumerate(original_messages):
-                    if message["role"] == "assistant":
-                        # Call the OpenAI API to generate the assistant's next response
-                        response = self._openai_client.chat.completions.create(
-                            model=model_id,
-                            messages=generated_completions,  # Entire conversation history up to the point of prediction
-                            max_tokens=150,
-                            temperature=0.7
-                        )
-                        generated_completions.append({
-                            "role": "assistant",
-                            "content": response['choices'][0]['message']['content'].strip()
-                        })
-                    else:
-                        generated_completions.append(message)
-
-                    generated_message = generated_completions[-1]
-                    table.add_data(
-                        conversation_idx,
-                        message_idx,
-                        generated_message["role"],
-                        message["content"],
-                        generated_message["content"]
-                    )
-                    run.log({"Validation predictions": table})
-
-                predictions.append(generated_completions)
-        except Exception as e:
-            print("Error generating chat val predictions: %s", str(e))
\ No newline at end of file
+            runner = BatchValidationRunner(
+                session,
+                self._openai_client,
+                self._async_openai_client,
+                model_id,
+                params,
+                f"validation_{wandb_experiment_id}",
+            )
+            return await runner.run(validation_dataset)
+        finally:
+            session.close()
@@ -0,0 +1,69 @@
+import asyncio
+from typing import Any, Callable, Dict, List
+
+import openai
+from openai import AsyncOpenAI
+
+
+TERMINAL_STATUSES = ("succeeded", "failed", "cancelled")
+
+MIN_POLL_INTERVAL_SECONDS = 10
+MAX_POLL_INTERVAL_SECONDS = 5 * 60
+
+# Follows a fine-tuning job through its event stream. New events are fetched newest first until the
+# last one already seen; step metrics are handed to on_metrics as soon as they are reported.
+class FineTuneTracker:
+    def __init__(self, client: AsyncOpenAI, job_id: str, on_metrics: Callable[[int, Dict[str, float]], None]):
+        self.client = client
+        self.job_id = job_id
+        self.on_metrics = on_metrics
+        self._last_event_id = None
+
+    async def wait(self):
+        interval = MIN_POLL_INTERVAL_SECONDS
+        status = None
+        while True:
+            events, job = [], None
+            try:
+                events = await self._new_events()
+                job = await self.client.fine_tuning.jobs.retrieve(self.job_id)
+            except openai.APIError as e:
+                print(f"Error polling fine-tuning job {self.job_id}: {e}")
+            for event in events:
+                self._handle(event)
+            if job is not None:
+                if job.status != status:
+                    print(f"Fine-tuning job {self.job_id}: {job.status}")
+                    status = job.status
+                if job.status in TERMINAL_STATUSES:
+                    # Events written between the last poll and the status change
+                    for event in await self._new_events():
+                        self._handle(event)
+                    return job
+
+            # Poll more often while the job is reporting, back off while it is queued or quiet
+            if events:
+                interval = MIN_POLL_INTERVAL_SECONDS
+            else:
+                interval = min(interval * 2, MAX_POLL_INTERVAL_SECONDS)
+            await asyncio.sleep(interval)
+
+    async def _new_events(self) -> List[Any]:
+        events = []
+        async for event in self.client.fine_tuning.jobs.list_events(self.job_id, limit=100):
+            if event.id == self._last_event_id:
+                break
+            events.append(event)
+        if events:
+            self._last_event_id = events[0].id
+        # Oldest first
+        return events[::-1]
+
+    def _handle(self, event):
+        if event.type == "metrics" and event.data:
+            data = dict(event.data)
+            step = data.pop("step", None)
+            if step is not None:
+                self.on_metrics(step, {k: v for k, v in data.items() if isinstance(v, (int, float))})
+        else:
+            print(f"Fine-tuning job {self.job_id}: {event.message}")
@@ -0,0 +1,67 @@
+import base64
+import hashlib
+import io
+import os
+from typing import Optional, Sequence
+
+from PIL import Image
+from telegram import PhotoSize
+
+
+def select_photo_size(sizes: Sequence[PhotoSize], max_edge: int) -> PhotoSize:
+    # Smallest size that still covers max_edge, falling back to the largest one
+    by_area = sorted(sizes, key=lambda s: s.width * s.height)
+    for size in by_area:
+        if max(size.width, size.height) >= max_edge:
+            return size
+    return by_area[-1]
+
+def downscale(image_bytes: bytes, max_edge: int, jpeg_quality: int) -> bytes:
+    image = Image.open(io.BytesIO(image_bytes))
+    image.thumbnail((max_edge, max_edge))
+    output = io.BytesIO()
+    image.convert("RGB").save(output, format="JPEG", quality=jpeg_quality, optimize=True)
+    return output.getvalue()
+
+# Content-addressed on-disk image store: images are referenced by the sha256 of their bytes,
+# and Telegram file_unique_ids map to those handles so that each photo is downloaded once
+class ImageStore:
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(os.path.join(root, "objects"), exist_ok=True)
+        os.makedirs(os.path.join(root, "telegram"), exist_ok=True)
+
+    def get_handle(self, telegram_unique_id: str) -> Optional[str]:
+        try:
+            with open(self._telegram_path(telegram_unique_id), "r") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, image_bytes: bytes, telegram_unique_id: Optional[str] = None) -> str:
+        handle = hashlib.sha256(image_bytes).hexdigest()
+        if not os.path.exists(self._object_path(handle)):
+            self._write_atomic(self._object_path(handle), image_bytes)
+        if telegram_unique_id is not None:
+            self._write_atomic(self._telegram_path(telegram_unique_id), handle.encode("utf-8"))
+        return handle
+
+    def read(self, handle: str) -> bytes:
+        with open(self._object_path(handle), "rb") as f:
+            return f.read()
+
+    def read_b64(self, handle: str) -> str:
+        return base64.b64encode(self.read(handle)).decode("utf-8")
+
+    def _object_path(self, handle: str) -> str:
+        return os.path.join(self.root, "objects", f"{handle}.jpg")
+
+    def _telegram_path(self, telegram_unique_id: str) -> str:
+        return os.path.join(self.root, "telegram", telegram_unique_id)
+
+    @staticmethod
+    def _write_atomic(path: str, data: bytes):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
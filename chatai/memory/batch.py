@@ -0,0 +1,124 @@
+import asyncio
+import hashlib
+import json
+import time
+from typing import Dict, Iterator, List, Optional
+
+import openai
+from openai import AsyncOpenAI, OpenAI
+from sqlalchemy.orm import Session
+
+from chatai.sql.tables import BatchJob
+
+
+ACTIVE_STATUSES = ("validating", "in_progress", "finalizing", "cancelling")
+
+MIN_POLL_INTERVAL_SECONDS = 30
+MAX_POLL_INTERVAL_SECONDS = 15 * 60
+
+def submit_batch_task(
+        session: Session,
+        client: OpenAI,
+        batch: List[Dict[str, ...]],
+        name: str,
+        end_unixtime: Optional[int] = None,
+) -> BatchJob:
+    content = "".join(json.dumps(r) + "\n" for r in batch).encode("utf-8")
+    content_hash = hashlib.sha256(content).hexdigest()
+
+    job = session.query(BatchJob).filter(BatchJob.content_hash == content_hash).one_or_none()
+    if job is not None and job.consumed_unixtime is not None:
+        print(f"Batch {job.batch_id} ({job.name}) was already processed")
+        return job
+    if job is not None and (job.status in ACTIVE_STATUSES or job.status == "completed"):
+        print(f"Resuming batch {job.batch_id} ({job.name}, {job.status})")
+        return job
+
+    # Uploaded from memory, nothing is written to the working directory
+    batch_input_file = client.files.create(
+        file=(f"{name}.jsonl", content),
+        purpose="batch",
+    )
+    bc = client.batches.create(
+        input_file_id=batch_input_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+        metadata={
+            "description": name
+        }
+    )
+
+    now = int(time.time())
+    if job is None:
+        job = BatchJob(name=name, content_hash=content_hash, created_unixtime=now, end_unixtime=end_unixtime)
+        session.add(job)
+    job.input_file_id = batch_input_file.id
+    job.batch_id = bc.id
+    job.status = bc.status
+    job.output_file_id = None
+    job.error_file_id = None
+    job.updated_unixtime = now
+    session.commit()
+    print(f"Submitted batch {job.batch_id} ({job.name})")
+    return job
+
+def get_unfinished_batch_tasks(session: Session, name_prefix: str) -> List[BatchJob]:
+    # Jobs left over from an interrupted run: still running, or completed but not yet processed
+    return session.query(BatchJob).filter(
+        BatchJob.name.startswith(name_prefix),
+        BatchJob.consumed_unixtime.is_(None),
+        BatchJob.status.in_(ACTIVE_STATUSES + ("completed",)),
+    ).all()
+
+async def wait_for_batch_tasks(session: Session, client: AsyncOpenAI, jobs: List[BatchJob]):
+    await asyncio.gather(*(_wait_for_batch_task(session, client, job) for job in jobs))
+
+async def _wait_for_batch_task(session: Session, client: AsyncOpenAI, job: BatchJob):
+    interval = MIN_POLL_INTERVAL_SECONDS
+    completed_requests = None
+    while job.status in ACTIVE_STATUSES:
+        try:
+            b = await client.batches.retrieve(job.batch_id)
+        except openai.APIError as e:
+            print(f"Error polling batch {job.batch_id}: {e}")
+        else:
+            # Poll more often while the job is making progress, back off while it isn't
+            progress = b.request_counts.completed if b.request_counts is not None else None
+            if b.status != job.status or progress != completed_requests:
+                interval = MIN_POLL_INTERVAL_SECONDS
+            else:
+                interval = min(interval * 2, MAX_POLL_INTERVAL_SECONDS)
+            completed_requests = progress
+            job.status = b.status
+            job.output_file_id = b.output_file_id
+            job.error_file_id = b.error_file_id
+            job.updated_unixtime = int(time.time())
+            session.commit()
+            if job.status not in ACTIVE_STATUSES:
+                break
+        await asyncio.sleep(interval)
+    print(f"Batch {job.batch_id} ({job.name}) finished with status {job.status}")
+
+def iter_batch_output(client: OpenAI, file_id: str) -> Iterator[str]:
+    # Output files can be hundreds of MB, so they are read line by line as they download
+    with client.files.with_streaming_response.content(file_id) as response:
+        for line in response.iter_lines():
+            if line:
+                yield line
+
+def report_batch_errors(client: OpenAI, job: BatchJob, max_printed: int = 5) -> int:
+    # Failed requests of a finished batch are listed in its error file, not in the output
+    if job.error_file_id is None:
+        return 0
+    errors = 0
+    for line in iter_batch_output(client, job.error_file_id):
+        if errors < max_printed:
+            print(f"Batch {job.batch_id} request failed: {line[:500]}")
+        errors += 1
+    if errors:
+        print(f"Batch {job.batch_id} ({job.name}): {errors} failed requests")
+    return errors
+
+def mark_consumed(session: Session, job: BatchJob):
+    job.consumed_unixtime = int(time.time())
+    session.commit()
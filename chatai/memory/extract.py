@@ -1,19 +1,47 @@
+import argparse
+import asyncio
+import base64
 import os
 import time
 import json
-from collections import defaultdict
 from dataclasses import dataclass
-from typing import Dict, List
+from datetime import datetime
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 
-from sqlalchemy import select, and_
+from openai import OpenAI
+from sqlalchemy import Row, select, and_
 from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session as SessionType, aliased
 
-from chatai import OPENAI_CLIENT
-from chatai.type_names import ChatMessage
+from chatai import OPENAI_CLIENT, ASYNC_OPENAI_CLIENT
+from chatai.type_names import ChatMessage, TypedContent
 from chatai.sql import Session
-from chatai.sql.tables import Message, Memory
+from chatai.sql.tables import BatchJob, Message, MessageImage, Memory, ExtractionWatermark
+from chatai.sql.writer import insert_ignore
 from chatai.prompt.chat import Chat
 from chatai.prompt.prompt import Prompt, ListSection, MainCharacter
+from chatai.prompt.versions import PromptVersions
+from chatai.memory.plan import (
+    ExtractionWindow,
+    PackingParams,
+    MESSAGE_OVERHEAD_TOKENS,
+    split_windows,
+    count_tokens,
+    chunk_messages,
+    truncate_messages,
+    pack_transcript,
+    pack_requests,
+    estimate_cost,
+)
+from chatai.memory.rank import RankedMemory, RankingParams, select_facts
+from chatai.memory.batch import (
+    submit_batch_task,
+    get_unfinished_batch_tasks,
+    wait_for_batch_tasks,
+    iter_batch_output,
+    report_batch_errors,
+    mark_consumed,
+)
 
 
 @dataclass
@@ -22,11 +50,14 @@ class ChatInfo:
     character_names: List[str]
 
 def extract_memories(
-        chat_info: ChatInfo,
-        start_unixtime_inclusive: int,
+        chats: List[ChatInfo],
         end_unixtime_exclusive: int,
+        window_seconds: int,
         model: str,
         max_tokens: int,
+        packing_params: PackingParams,
+        ranking_params: RankingParams,
+        backfill_start_unixtime: Optional[int] = None,
 ):
     print("Reading prompts...")
     with open(os.getenv("SYSTEM_MEMORY_PROMPT_PATH"), "r") as f:
@@ -34,52 +65,56 @@ def extract_memories(
     with open(os.getenv("EXTRACT_MEMORY_PROMPT_PATH"), "r") as f:
         memory_prompt = f.read()
 
-    print("Reading messages...")
-    message_rows = read_messages(chat_info.id, start_unixtime_inclusive, end_unixtime_exclusive)
-    print("Reading quoted messages...")
-    quoted_message_rows = read_messages_by_ids(
-        list(set(m.reply_to_message_id for m in message_rows if m.reply_to_message_id))
-    )
-    print("Encoding messages...")
-    chat_messages = encode_messages(message_rows, quoted_message_rows)
-    chat_messages = [m for m in chat_messages if not (("(от: Бугимен)" in m) or ("(ответ на: Бугимен" in m) or ("boggeyman_ai_bot" in m))]
-    print(chat_messages)
-
-    print("Making request...")
-    request_id = f"memory_extraction_{chat_info.id}_{start_unixtime_inclusive}_{end_unixtime_exclusive}"
-    request = make_request(
-        request_id,
-        chat_info.character_names,
-        chat_messages,
-        system_prompt,
-        memory_prompt,
-        model,
-        max_tokens,
-    )
-    print("Submitting request...")
-    response = submit_and_wait_batch_task(OPENAI_CLIENT, [request], request_id)
-    print("Parsing results...")
-    memories = [json.loads(n.strip('\n')) for n in response.text.split('\n')[:-1]]
-
-    print("Dumping results...")
-    dump_memories(memories, chat_info.id, start_unixtime_inclusive, end_unixtime_exclusive)
-
-    print("Exporting prompt...")
-    export_prompt()
-
-
-def read_messages(chat_id: int, start_unixtime_inclusive: int, end_unixtime_exclusive: int) -> List[Message]:
     try:
         session = Session()
 
-        select_statement = select(Message).where(
-            and_(
-                Message.chat_id == chat_id,
-                Message.unixtime >= start_unixtime_inclusive,
-                Message.unixtime < end_unixtime_exclusive,
-            )
+        jobs, end_unixtime_exclusive, watermarks = submit_extraction(
+            session,
+            OPENAI_CLIENT,
+            chats,
+            end_unixtime_exclusive,
+            window_seconds,
+            model,
+            max_tokens,
+            packing_params,
+            system_prompt,
+            memory_prompt,
+            backfill_start_unixtime,
         )
-        return session.execute(select_statement).scalars().all()
+        if jobs:
+            print(f"Waiting for {len(jobs)} batches...")
+            asyncio.run(wait_for_batch_tasks(session, ASYNC_OPENAI_CLIENT, jobs))
+
+        all_completed = True
+        for job in jobs:
+            if job.status != "completed":
+                print(f"Skipping batch {job.batch_id} ({job.name}) with status {job.status}")
+                all_completed = False
+                continue
+            if job.output_file_id is not None:
+                print(f"Dumping results of batch {job.batch_id}...")
+                report = dump_memories(
+                    session,
+                    iter_batch_output(OPENAI_CLIENT, job.output_file_id),
+                    {chat_info.id: chat_info.character_names for chat_info in chats},
+                )
+            else:
+                print(f"Batch {job.batch_id} ({job.name}) has no output file")
+                report = DumpReport()
+            report.errors = report_batch_errors(OPENAI_CLIENT, job)
+            print(f"Batch {job.batch_id}: {report}")
+            # Memories and the consumed mark are committed together
+            mark_consumed(session, job)
+
+        # With a failed batch the windows are retried next run; already stored facts are skipped then
+        if all_completed:
+            for chat_info in chats:
+                set_watermark(session, chat_info.id, max(end_unixtime_exclusive, watermarks.get(chat_info.id, 0)))
+        else:
+            print("Not advancing watermarks")
+
+        print("Exporting prompt...")
+        export_prompt(session, ranking_params)
 
     except SQLAlchemyError as e:
         session.rollback()
@@ -88,35 +123,142 @@ def read_messages(chat_id: int, start_unixtime_inclusive: int, end_unixtime_excl
         session.close()
 
 
-def read_messages_by_ids(ids: List[int]) -> List[Message]:
-    try:
-        session = Session()
-
-        select_statement = select(Message).where(
-            Message.id.in_(ids)
+def submit_extraction(
+        session: SessionType,
+        client: OpenAI,
+        chats: List[ChatInfo],
+        end_unixtime_exclusive: int,
+        window_seconds: int,
+        model: str,
+        max_tokens: int,
+        packing_params: PackingParams,
+        system_prompt: str,
+        memory_prompt: str,
+        backfill_start_unixtime: Optional[int] = None,
+) -> Tuple[List[BatchJob], int, Dict[int, int]]:
+    # Batches submitted by an interrupted run are picked up instead of being paid for again
+    jobs = get_unfinished_batch_tasks(session, "memory_extraction")
+    if jobs:
+        print(f"Resuming {len(jobs)} unfinished batches...")
+        end_unixtime_exclusive = resume_end_unixtime(jobs, end_unixtime_exclusive)
+
+    # Each chat continues from its watermark; a backfill re-walks history from the given start
+    watermarks = get_watermarks(session, [chat_info.id for chat_info in chats])
+    start_by_chat = {}
+    for chat_info in chats:
+        if backfill_start_unixtime is not None:
+            start_by_chat[chat_info.id] = backfill_start_unixtime
+        else:
+            start_by_chat[chat_info.id] = watermarks.get(chat_info.id, end_unixtime_exclusive - window_seconds)
+
+    print("Planning requests...")
+    requests = []
+    input_tokens = 0
+    prompt_tokens = count_tokens(system_prompt, model) + count_tokens(memory_prompt, model) + 2 * MESSAGE_OVERHEAD_TOKENS
+    for chat_info in chats:
+        for window in split_windows(chat_info.id, start_by_chat[chat_info.id], end_unixtime_exclusive, window_seconds):
+            chat_messages = encode_messages(
+                read_messages(session, window.chat_id, window.start_unixtime_inclusive, window.end_unixtime_exclusive)
+            )
+            chat_messages = [m for m in chat_messages if not (("(от: Бугимен)" in m) or ("(ответ на: Бугимен" in m) or ("boggeyman_ai_bot" in m))]
+            # Each message is tokenized once and its count reused for chunking and packing
+            token_counts = [count_tokens(m, model) + MESSAGE_OVERHEAD_TOKENS for m in chat_messages]
+            chat_messages, token_counts = truncate_messages(
+                chat_messages,
+                token_counts,
+                packing_params.max_input_tokens - prompt_tokens,
+                model,
+            )
+            chunks = chunk_messages(
+                chat_messages,
+                token_counts,
+                packing_params.max_input_tokens - prompt_tokens,
+                packing_params.overlap_messages,
+            )
+            for part, (chunk, chunk_token_counts) in enumerate(chunks):
+                input_tokens += prompt_tokens + sum(chunk_token_counts)
+                requests.append(make_request(
+                    window.custom_id(part),
+                    chat_info.character_names,
+                    pack_transcript(chunk, chunk_token_counts, packing_params.max_block_tokens),
+                    system_prompt,
+                    memory_prompt,
+                    model,
+                    max_tokens,
+                ))
+    session.commit()
+
+    if requests:
+        batches = pack_requests(requests)
+        cost = estimate_cost(model, input_tokens, max_tokens * len(requests))
+        cost_str = f"at most ${cost:.2f}" if cost is not None else f"no price for {model}"
+        print(f"Submitting {len(requests)} requests in {len(batches)} batches: {input_tokens} input tokens, {cost_str}")
+        name = f"memory_extraction_{min(start_by_chat.values())}_{end_unixtime_exclusive}"
+        for i, batch in enumerate(batches):
+            job = submit_batch_task(session, client, batch, f"{name}_{i}", end_unixtime_exclusive)
+            if job.consumed_unixtime is None and all(job.id != j.id for j in jobs):
+                jobs.append(job)
+    return jobs, end_unixtime_exclusive, watermarks
+
+def resume_end_unixtime(jobs: List[BatchJob], end_unixtime_exclusive: int) -> int:
+    # A resumed run plans up to the end it was submitted with. Planning up to a later end would pack different
+    # batch files, and windows already covered by the unfinished jobs would be paid for a second time.
+    planned_ends = [job.end_unixtime for job in jobs if job.end_unixtime is not None]
+    if not planned_ends:
+        return end_unixtime_exclusive
+    print(f"Planning up to {max(planned_ends)} as the interrupted run did, not {end_unixtime_exclusive}")
+    return max(planned_ends)
+
+READ_CHUNK_SIZE = 1000
+
+def read_messages(
+        session: SessionType,
+        chat_id: int,
+        start_unixtime_inclusive: int,
+        end_unixtime_exclusive: int,
+) -> Iterator[Row]:
+    # Only the columns needed for encoding; quoted messages and images come from outer self-joins
+    quoted = aliased(Message)
+    image = aliased(MessageImage)
+    quoted_image = aliased(MessageImage)
+    select_statement = (
+        select(
+            Message.username,
+            Message.text,
+            Message.unixtime,
+            image.data.label("image"),
+            quoted.username.label("quoted_username"),
+            quoted.text.label("quoted_text"),
+            quoted.unixtime.label("quoted_unixtime"),
+            quoted_image.data.label("quoted_image"),
         )
-        return session.execute(select_statement).scalars().all()
-
-    except SQLAlchemyError as e:
-        session.rollback()
-        raise e
-    finally:
-        session.close()
-
-def encode_messages(message_rows: List[Message], quoted_messages: List[Message]) -> List[str]:
-    quoted_message_by_id = {m.id: m for m in quoted_messages}
+        # Message ids repeat across chats, every join is within the chat
+        .outerjoin(image, and_(image.message_id == Message.id, image.chat_id == Message.chat_id))
+        .outerjoin(quoted, and_(quoted.id == Message.reply_to_message_id, quoted.chat_id == Message.chat_id))
+        .outerjoin(quoted_image, and_(quoted_image.message_id == quoted.id, quoted_image.chat_id == quoted.chat_id))
+        .where(
+            and_(
+                Message.chat_id == chat_id,
+                Message.unixtime >= start_unixtime_inclusive,
+                Message.unixtime < end_unixtime_exclusive,
+            )
+        )
+        .order_by(Message.unixtime)
+        .execution_options(yield_per=READ_CHUNK_SIZE)
+    )
+    return iter(session.execute(select_statement))
 
+def encode_messages(rows: Iterable[Row]) -> List[str]:
     prompt = Chat(os.getenv("SYSTEM_MEMORY_PROMPT_PATH"))
     chat_messages = []
-    for row in message_rows:
+    for row in rows:
         quoted_message = None
-        if row.reply_to_message_id:
-            quoted_message_row = quoted_message_by_id[row.reply_to_message_id]
+        if row.quoted_unixtime is not None:
             quoted_message = ChatMessage(
-                quoted_message_row.username,
-                quoted_message_row.text,
-                quoted_message_row.unixtime,
-                quoted_message_row.image_b64_encoded,
+                row.quoted_username,
+                row.quoted_text,
+                row.quoted_unixtime,
+                _b64_encode(row.quoted_image),
                 None,
             )
         chat_messages.append(
@@ -125,18 +267,23 @@ def encode_messages(message_rows: List[Message], quoted_messages: List[Message])
                     row.username,
                     row.text,
                     row.unixtime,
-                    row.image_b64_encoded,
+                    _b64_encode(row.image),
                     quoted_message,
                 )
             )
         )
     return chat_messages
 
+def _b64_encode(data: Optional[bytes]) -> Optional[str]:
+    if data is None:
+        return None
+    return base64.b64encode(data).decode("utf-8")
+
 
 def make_request(
         custom_id: str,
         character_names: List[str],
-        messages: List[str],
+        messages: List[str | List[TypedContent]],
         system_prompt: str,
         memory_prompt: str,
         model: str,
@@ -196,97 +343,146 @@ def make_request(
         }
     }
 
-def submit_and_wait_batch_task(client, batch, name):
-    filename = f'{name}.jsonl'
-    with open(filename, 'w') as f:
-        f.writelines([json.dumps(r) + '\n' for r in batch])
-
-    batch_input_file = client.files.create(
-      file=open(filename, "rb"),
-      purpose="batch"
-    )
+MEMORY_INSERT_CHUNK_SIZE = 1000
 
-    batch_input_file_id = batch_input_file.id
-    bc = client.batches.create(
-        input_file_id=batch_input_file_id,
-        endpoint="/v1/chat/completions",
-        completion_window="24h",
-        metadata={
-          "description": filename[:-6]
-        }
-    )
+@dataclass
+class DumpReport:
+    lines: int = 0
+    memories: int = 0
+    failed: int = 0
+    refused: int = 0
+    malformed: int = 0
+    # Requests listed in the batch error file
+    errors: int = 0
+
+class MalformedLineError(ValueError):
+    pass
+
+class RefusedLineError(ValueError):
+    pass
+
+class FailedLineError(ValueError):
+    pass
+
+def dump_memories(
+        session: SessionType,
+        lines: Iterable[str],
+        character_names_by_chat: Dict[int, List[str]],
+) -> DumpReport:
+    report = DumpReport()
+    rows = []
+    try:
+        for line in lines:
+            report.lines += 1
+            try:
+                rows.extend(parse_memory_line(line, character_names_by_chat))
+            except FailedLineError as e:
+                report.failed += 1
+                print(f"Failed: {e}")
+            except RefusedLineError as e:
+                report.refused += 1
+                print(f"Refused: {e}")
+            except MalformedLineError as e:
+                report.malformed += 1
+                print(f"Malformed: {e}")
+
+            if len(rows) >= MEMORY_INSERT_CHUNK_SIZE:
+                report.memories += _insert_memories(session, rows)
+                rows = []
+        if rows:
+            report.memories += _insert_memories(session, rows)
 
-    while True:
-        b = client.batches.retrieve(bc.id)
-        if b.status in ("validating", "in_progress", "finalizing"):
-            time.sleep(60)
-        else:
-            break
+    except Exception as e:
+        session.rollback()
+        raise e
+    return report
 
-    return client.files.content(b.output_file_id)
+def _insert_memories(session: SessionType, rows: List[Dict[str, ...]]) -> int:
+    # Facts already stored for the chat are skipped by the unique index
+    statement = insert_ignore(Memory.__table__, session.get_bind().dialect.name).values(rows)
+    return session.execute(statement).rowcount
 
-def dump_memories(memories, chat_id: int, start_unixtime: int, end_unixtime: int) -> List[Memory]:
+def parse_memory_line(line: str, character_names_by_chat: Dict[int, List[str]]) -> List[Dict[str, ...]]:
     try:
-        session = Session()
+        row = json.loads(line)
+        custom_id = row["custom_id"]
+        window = ExtractionWindow.from_custom_id(custom_id)
+    except (ValueError, KeyError, TypeError) as e:
+        raise MalformedLineError(f"unparseable line: {e}")
 
-        result = []
-        for row in memories:
-            mm = row["response"]["body"]["choices"]
-            for rrow in mm:
-                memories_structs = json.loads(rrow["message"]["content"])["facts"]
-                for struct in memories_structs:
-                    component = Memory(
-                        chat_id=chat_id,
-                        start_unixtime=start_unixtime,
-                        end_unixtime=end_unixtime,
-                        character_name=struct["character_name"],
-                        fact=struct["fact"],
-                        interest_score=struct["interest_score"],
-                    )
-                    result.append(component)
-                    session.add(component)
-        session.commit()
+    if row.get("error") or (row.get("response") or {}).get("status_code", 200) != 200:
+        raise FailedLineError(f"{custom_id}: {row.get('error') or row['response'].get('body')}")
 
-    except Exception as e:
-        session.rollback()
-        raise e
-    finally:
-        session.close()
+    character_names = character_names_by_chat.get(window.chat_id)
+    result = []
+    try:
+        for choice in row["response"]["body"]["choices"]:
+            message = choice["message"]
+            if message.get("refusal"):
+                raise RefusedLineError(f"{custom_id}: {message['refusal']}")
+            facts = json.loads(message["content"])["facts"]
+            for struct in facts:
+                if not isinstance(struct["fact"], str) or not isinstance(struct["character_name"], str):
+                    raise MalformedLineError(f"{custom_id}: fact and character_name must be strings")
+                if character_names is not None and struct["character_name"] not in character_names:
+                    raise MalformedLineError(f"{custom_id}: unknown character {struct['character_name']}")
+                if not isinstance(struct["interest_score"], (int, float)) or not 0 <= struct["interest_score"] <= 1:
+                    raise MalformedLineError(f"{custom_id}: interest_score must be a number from 0 to 1")
+                result.append(dict(
+                    chat_id=window.chat_id,
+                    start_unixtime=window.start_unixtime_inclusive,
+                    end_unixtime=window.end_unixtime_exclusive,
+                    character_name=struct["character_name"],
+                    fact=struct["fact"],
+                    interest_score=struct["interest_score"],
+                    fact_hash=Memory.hash_fact(struct["character_name"], struct["fact"]),
+                ))
+    except (MalformedLineError, RefusedLineError):
+        raise
+    except (ValueError, KeyError, TypeError) as e:
+        raise MalformedLineError(f"{custom_id}: {e!r}")
     return result
 
-def export_prompt():
+def get_watermarks(session: SessionType, chat_ids: List[int]) -> Dict[int, int]:
+    select_statement = select(ExtractionWatermark).where(ExtractionWatermark.chat_id.in_(chat_ids))
+    return {w.chat_id: w.end_unixtime for w in session.execute(select_statement).scalars()}
+
+def set_watermark(session: SessionType, chat_id: int, end_unixtime: int):
+    session.merge(ExtractionWatermark(chat_id=chat_id, end_unixtime=end_unixtime, updated_unixtime=int(time.time())))
+    session.commit()
+
+PROMPT_VERSIONS_PATH = "chatai/prompt_versions"
+
+def export_prompt(session: SessionType, ranking_params: RankingParams):
     prompt = Prompt("chatai/prompt.yaml")
 
-    new_recent_memories = prepare_memories_by_user()
-    print((name, [m.fact for m in mem]) for name, mem in new_recent_memories.items())
+    new_recent_facts = prepare_memories_by_user(session, ranking_params)
+    for name, facts in new_recent_facts.items():
+        print(name, facts)
     for i, component in enumerate(prompt.config):
         if not isinstance(component, ListSection) or not isinstance(component.items[0], MainCharacter):
             continue
         for char in component.items:
             c: MainCharacter = char
-            c.recent_facts = [m.fact for m in new_recent_memories[c.name]]
-
-    prompt.save_config("chatai/prompt.yaml")
-    with open("chatai/prompt.txt", "w") as f:
-        f.write(prompt.print())
-
-def prepare_memories_by_user() -> Dict[str, List[Memory]]:
-    try:
-        session = Session()
+            c.recent_facts = new_recent_facts.get(c.name, [])
 
-        earliest_ts = int(time.time()) - 7 * 60 * 60 * 24
-        query = session.query(Memory).filter(Memory.start_unixtime >= earliest_ts)
-        memories = query.all()
-    except Exception as e:
-        session.rollback()
-        raise e
-    finally:
-        session.close()
+    PromptVersions(PROMPT_VERSIONS_PATH, "chatai/prompt.yaml", "chatai/prompt.txt").publish(prompt)
 
-    result = defaultdict(list)
-    for m in memories:
-        result[m.character_name].append(m)
-    return result
+def prepare_memories_by_user(session: SessionType, ranking_params: RankingParams) -> Dict[str, List[str]]:
+    # Top facts per character by decayed interest score, with near-duplicates collapsed
+    now = int(time.time())
+    earliest_ts = now - ranking_params.lookback_days * 60 * 60 * 24
+    select_statement = select(
+        Memory.character_name,
+        Memory.fact,
+        Memory.interest_score,
+        Memory.end_unixtime,
+    ).where(Memory.start_unixtime >= earliest_ts)
+    memories = [
+        RankedMemory(row.character_name, row.fact, float(row.interest_score or 0), row.end_unixtime or now)
+        for row in session.execute(select_statement)
+    ]
+    return select_facts(memories, now, ranking_params)
 
 if __name__ == "__main__":
     names = [
@@ -300,16 +496,44 @@ if __name__ == "__main__":
                                     "Андрей Гайбун",
                                 ]
 
-    LOOKBACK_DAYS = 1
-    CHAT_ID = -1001783745747
+    CHATS = [
+        ChatInfo(-1001783745747, names),
+    ]
+    WINDOW_SECONDS = 60 * 60 * 24
+    # Leaves time for messages still queued in the bot's writer
+    LAG_SECONDS = 5 * 60
     MODEL = "gpt-4o-2024-08-06"
     MAX_TOKENS = 2000
+    PACKING_PARAMS = PackingParams(
+        max_input_tokens=60000,
+        max_block_tokens=2000,
+        overlap_messages=20,
+    )
+    RANKING_PARAMS = RankingParams(
+        lookback_days=30,
+        top_k=15,
+        half_life_days=7,
+        duplicate_threshold=0.5,
+        max_tokens_per_character=600,
+        tokenizer_model=MODEL,
+    )
+
+    parser = argparse.ArgumentParser(description="Extract character memories from new chat messages")
+    parser.add_argument(
+        "--backfill",
+        type=str,
+        help="Re-extract all history since this date (YYYY-MM-DD), one batch request per window",
+        default=None,
+    )
+    args = parser.parse_args()
 
-    now = int(time.time())
     extract_memories(
-        ChatInfo(CHAT_ID, names),
-        now - 60 * 60 * 24,
-        now,
+        CHATS,
+        int(time.time()) - LAG_SECONDS,
+        WINDOW_SECONDS,
         MODEL,
         MAX_TOKENS,
-    )
\ No newline at end of file
+        PACKING_PARAMS,
+        RANKING_PARAMS,
+        int(datetime.fromisoformat(args.backfill).timestamp()) if args.backfill else None,
+    )
@@ -0,0 +1,187 @@
+import json
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+import tiktoken
+
+from chatai.type_names import TypedContent
+
+
+# Batch API limits per input file
+MAX_BATCH_REQUESTS = 50_000
+MAX_BATCH_FILE_BYTES = 200 * 1024 * 1024
+
+# Rough cost of one image in a vision request
+IMAGE_TOKENS = 765
+# Per-message formatting overhead of the chat format
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# Batch API prices, USD per million (input, output) tokens
+BATCH_PRICES_PER_MILLION = {
+    "gpt-4o-2024-08-06": (1.25, 5.0),
+    "gpt-4o-mini": (0.075, 0.3),
+}
+
+@dataclass
+class PackingParams:
+    # Input budget per request, including the system prompts
+    max_input_tokens: int
+    # Consecutive text messages are merged into transcript blocks of up to this size
+    max_block_tokens: int
+    # Messages repeated at the start of the next sub-request when a window is split
+    overlap_messages: int
+
+@dataclass(frozen=True)
+class ExtractionWindow:
+    chat_id: int
+    start_unixtime_inclusive: int
+    end_unixtime_exclusive: int
+
+    def custom_id(self, part: int) -> str:
+        return f"memory_extraction_{self.chat_id}_{self.start_unixtime_inclusive}_{self.end_unixtime_exclusive}_{part}"
+
+    @staticmethod
+    def from_custom_id(custom_id: str) -> 'ExtractionWindow':
+        # Results are self-describing, so output of a resumed batch can be attributed without extra state
+        chat_id, start, end, _ = custom_id[len("memory_extraction_"):].rsplit("_", 3)
+        return ExtractionWindow(int(chat_id), int(start), int(end))
+
+def split_windows(
+        chat_id: int,
+        start_unixtime_inclusive: int,
+        end_unixtime_exclusive: int,
+        window_seconds: int,
+) -> List[ExtractionWindow]:
+    return [
+        ExtractionWindow(chat_id, start, min(start + window_seconds, end_unixtime_exclusive))
+        for start in range(start_unixtime_inclusive, end_unixtime_exclusive, window_seconds)
+    ]
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str) -> tiktoken.Encoding:
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+def count_tokens(content: str | List[TypedContent], model: str) -> int:
+    if isinstance(content, str):
+        return len(get_encoding(model).encode(content))
+    return sum(
+        count_tokens(component["text"], model) if component["type"] == "text" else IMAGE_TOKENS
+        for component in content
+    )
+
+def chunk_messages(
+        messages: List[str | List[TypedContent]],
+        token_counts: List[int],
+        max_tokens: int,
+        overlap_messages: int,
+) -> List[Tuple[List[str | List[TypedContent]], List[int]]]:
+    # Windows that don't fit the budget are split into sub-requests that overlap by a few messages.
+    # Messages over the budget on their own are expected to be truncated beforehand (see truncate_messages).
+    chunks = []
+    start = 0
+    while start < len(messages):
+        end = start
+        tokens = 0
+        while end < len(messages) and (end == start or tokens + token_counts[end] <= max_tokens):
+            tokens += token_counts[end]
+            end += 1
+        chunks.append((messages[start:end], token_counts[start:end]))
+        if end == len(messages):
+            break
+        # Overlap is dropped from the front until the next message fits with it, so every chunk ends past the previous one
+        start = max(end - overlap_messages, start + 1)
+        overlap_tokens = sum(token_counts[start:end])
+        while start < end and overlap_tokens + token_counts[end] > max_tokens:
+            overlap_tokens -= token_counts[start]
+            start += 1
+    return chunks
+
+def truncate_messages(
+        messages: List[str | List[TypedContent]],
+        token_counts: List[int],
+        max_tokens: int,
+        model: str,
+) -> Tuple[List[str | List[TypedContent]], List[int]]:
+    # A single message over the request budget is cut to fit instead of being sent oversized
+    result_messages = []
+    result_counts = []
+    for message, tokens in zip(messages, token_counts):
+        if tokens > max_tokens:
+            print(f"Truncating a message of {tokens} tokens to {max_tokens}")
+            message = _truncate_content(message, max_tokens - MESSAGE_OVERHEAD_TOKENS, model)
+            tokens = count_tokens(message, model) + MESSAGE_OVERHEAD_TOKENS
+        result_messages.append(message)
+        result_counts.append(tokens)
+    return result_messages, result_counts
+
+def _truncate_content(content: str | List[TypedContent], max_tokens: int, model: str) -> str | List[TypedContent]:
+    encoding = get_encoding(model)
+    if isinstance(content, str):
+        return encoding.decode(encoding.encode(content)[:max(max_tokens, 0)])
+    result = []
+    remaining = max_tokens - IMAGE_TOKENS * sum(1 for component in content if component["type"] != "text")
+    for component in content:
+        if component["type"] == "text":
+            tokens = encoding.encode(component["text"])[:max(remaining, 0)]
+            remaining -= len(tokens)
+            component = {"type": "text", "text": encoding.decode(tokens)}
+        result.append(component)
+    return result
+
+def pack_transcript(
+        messages: List[str | List[TypedContent]],
+        token_counts: List[int],
+        max_block_tokens: int,
+) -> List[str | List[TypedContent]]:
+    # Consecutive text messages become one newline-separated block; messages with images stay as they are
+    blocks = []
+    texts = []
+    block_tokens = 0
+    for message, tokens in zip(messages, token_counts):
+        if isinstance(message, str) and (not texts or block_tokens + tokens <= max_block_tokens):
+            texts.append(message)
+            block_tokens += tokens
+            continue
+        if texts:
+            blocks.append("\n".join(texts))
+            texts = []
+            block_tokens = 0
+        if isinstance(message, str):
+            texts.append(message)
+            block_tokens = tokens
+        else:
+            blocks.append(message)
+    if texts:
+        blocks.append("\n".join(texts))
+    return blocks
+
+def estimate_cost(model: str, input_tokens: int, max_output_tokens: int) -> Optional[float]:
+    if model not in BATCH_PRICES_PER_MILLION:
+        return None
+    input_price, output_price = BATCH_PRICES_PER_MILLION[model]
+    return (input_tokens * input_price + max_output_tokens * output_price) / 1_000_000
+
+def pack_requests(
+        requests: List[Dict[str, ...]],
+        max_requests: int = MAX_BATCH_REQUESTS,
+        max_bytes: int = MAX_BATCH_FILE_BYTES,
+) -> List[List[Dict[str, ...]]]:
+    # Fill batch files in order until either the line or the size limit would be exceeded
+    batches = []
+    batch = []
+    batch_bytes = 0
+    for request in requests:
+        request_bytes = len(json.dumps(request).encode("utf-8")) + 1
+        if batch and (len(batch) >= max_requests or batch_bytes + request_bytes > max_bytes):
+            batches.append(batch)
+            batch = []
+            batch_bytes = 0
+        batch.append(request)
+        batch_bytes += request_bytes
+    if batch:
+        batches.append(batch)
+    return batches
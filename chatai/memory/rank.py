@@ -0,0 +1,86 @@
+import hashlib
+import math
+import random
+import re
+from dataclasses import dataclass
+from typing import Dict, List, Sequence, Tuple
+
+from chatai.memory.plan import count_tokens
+
+
+@dataclass
+class RankingParams:
+    # Memories older than this are not considered at all
+    lookback_days: int
+    top_k: int
+    # Score halves every half_life_days
+    half_life_days: float
+    # Facts with estimated Jaccard similarity above this are collapsed into the higher-scored one
+    duplicate_threshold: float
+    max_tokens_per_character: int
+    tokenizer_model: str
+
+@dataclass
+class RankedMemory:
+    character_name: str
+    fact: str
+    interest_score: float
+    end_unixtime: int
+
+class MinHash:
+    # Signatures over character shingles, so that facts differing in word forms still match
+    _PRIME = (1 << 61) - 1
+
+    def __init__(self, num_permutations: int = 64, shingle_size: int = 4, seed: int = 0):
+        self.shingle_size = shingle_size
+        rng = random.Random(seed)
+        self._permutations = [
+            (rng.randrange(1, self._PRIME), rng.randrange(0, self._PRIME)) for _ in range(num_permutations)
+        ]
+
+    def signature(self, text: str) -> Tuple[int, ...]:
+        normalized = re.sub(r"\W+", " ", text.lower()).strip()
+        shingles = {
+            normalized[i:i + self.shingle_size]
+            for i in range(max(len(normalized) - self.shingle_size + 1, 1))
+        }
+        hashes = [int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "little") for s in shingles]
+        return tuple(
+            min((a * h + b) % self._PRIME for h in hashes)
+            for a, b in self._permutations
+        )
+
+    @staticmethod
+    def similarity(first: Sequence[int], second: Sequence[int]) -> float:
+        return sum(x == y for x, y in zip(first, second)) / len(first)
+
+def score(memory: RankedMemory, now: int, half_life_days: float) -> float:
+    age_days = max(now - memory.end_unixtime, 0) / (60 * 60 * 24)
+    return memory.interest_score * math.pow(0.5, age_days / half_life_days)
+
+def select_facts(memories: List[RankedMemory], now: int, params: RankingParams) -> Dict[str, List[str]]:
+    by_character: Dict[str, List[RankedMemory]] = {}
+    for memory in memories:
+        by_character.setdefault(memory.character_name, []).append(memory)
+
+    minhash = MinHash()
+    result = {}
+    for character_name, character_memories in by_character.items():
+        character_memories.sort(key=lambda m: score(m, now, params.half_life_days), reverse=True)
+        facts = []
+        signatures = []
+        tokens = 0
+        for memory in character_memories:
+            if len(facts) >= params.top_k:
+                break
+            signature = minhash.signature(memory.fact)
+            if any(MinHash.similarity(signature, s) >= params.duplicate_threshold for s in signatures):
+                continue
+            fact_tokens = count_tokens(memory.fact, params.tokenizer_model)
+            if tokens + fact_tokens > params.max_tokens_per_character:
+                continue
+            facts.append(memory.fact)
+            signatures.append(signature)
+            tokens += fact_tokens
+        result[character_name] = facts
+    return result
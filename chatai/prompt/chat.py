@@ -1,7 +1,10 @@
-from typing import Dict, List
+from typing import Dict, List, Optional
 
 from chatai.type_names import ChatMessage, CompletionMessage, TypedContent
-from chatai.prompt.prompt import Prompt
+from chatai.prompt.prompt import PROMPT_CACHE
+from chatai.util import EncodingCache
+from chatai.image import ImageStore
+from chatai.prompt.retrieval import FactRetriever
 
 
 USERNAME_TO_DISPLAY_NAME = {
@@ -19,13 +22,32 @@ USERNAME_TO_DISPLAY_NAME = {
 FOCUS_PROMPT = "Отвечай только на текст последнего сообщения. Иногда сообщение может начинаться с «(от: …)», тут будет написано имя того, кто тебе пишет, используй это, чтобы сделать ответ контекстным, но помимо этого не используй эту часть. Иногда сообщение может начинаться с «(ответ на: …)», в таких случаях сообщение - это ответ на другое сообщение, его текст приведен в этом блоке. Если нужно, используй его, чтобы сделать ответ контекстным. Но твоя основная задача - ответить на основной текст сообщения, для этого используй только текст после вступительных секций «от» и «ответ на». НИКОГДА и ни при каких условиях не добавляй в ответ цитируемые сообщения, «от» или «ответ на»."
 
 class Chat:
-    def __init__(self, prompt_config_file_path: str):
+    def __init__(
+            self,
+            prompt_config_file_path: str,
+            stable_prompt: bool = False,
+            encoding_cache: Optional[EncodingCache] = None,
+            image_store: Optional[ImageStore] = None,
+            fact_retriever: Optional[FactRetriever] = None,
+    ):
         self.prompt_config_file_path = prompt_config_file_path
+        self.stable_prompt = stable_prompt
+        self.encoding_cache = encoding_cache
+        self.image_store = image_store
+        self.fact_retriever = fact_retriever
         
     def generate(self, messages: List[ChatMessage]) -> List[CompletionMessage]:
-        system_prompt = Prompt(self.prompt_config_file_path)
+        if self.fact_retriever is not None:
+            system_prompt = self.fact_retriever.render(
+                self.prompt_config_file_path,
+                "\n".join(Chat._message_text(message) for message in messages),
+                {USERNAME_TO_DISPLAY_NAME[m.username] for m in messages if m.username in USERNAME_TO_DISPLAY_NAME},
+            )
+        else:
+            system_prompt = PROMPT_CACHE.get(self.prompt_config_file_path, self.stable_prompt)
+        # Static parts go first so that consecutive requests share the longest possible prefix
         result = [
-            {"role": "system", "content": system_prompt.print()},
+            {"role": "system", "content": system_prompt},
             {"role": "system", "content": FOCUS_PROMPT}
         ]
         for message in messages:
@@ -34,7 +56,23 @@ class Chat:
             result.append({"role": role, "content": content})
         return result
         
+    @staticmethod
+    def _message_text(message: ChatMessage) -> str:
+        if message.reply_to_message is not None:
+            return f"{Chat._message_text(message.reply_to_message)}\n{message.text or ''}"
+        return message.text or ""
+
     def encode(self, message: ChatMessage) -> str | List[TypedContent]:
+        if self.encoding_cache is None:
+            return self._encode(message)
+        key = EncodingCache.key(message)
+        content = self.encoding_cache.get(key)
+        if content is None:
+            content = self._encode(message)
+            self.encoding_cache.put(key, content)
+        return content
+
+    def _encode(self, message: ChatMessage) -> str | List[TypedContent]:
         user = USERNAME_TO_DISPLAY_NAME.get(message.username, "Незнакомец")
         user_part = f"(от: {user}) "
         
@@ -56,7 +94,9 @@ class Chat:
         images = []
         if reply_image is not None:
             images.append(reply_image)
-        if message.image_b64_encoded is not None:
+        if message.image_handle is not None and self.image_store is not None:
+            images.append({"url": f"data:image/jpeg;base64,{self.image_store.read_b64(message.image_handle)}"})
+        elif message.image_b64_encoded is not None:
             images.append({"url": f"data:image/jpeg;base64,{message.image_b64_encoded}"})
         if len(images) > 0:
             result = []
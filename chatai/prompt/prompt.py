@@ -1,7 +1,11 @@
 from ruamel import yaml
+import io
+import os
 import random
+import threading
+import zlib
 from abc import abstractmethod, ABCMeta
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional, Tuple
 
 from sqlalchemy.dialects.mysql.mariadb import loader
 
@@ -9,6 +13,12 @@ from sqlalchemy.dialects.mysql.mariadb import loader
 YAML = yaml.YAML(typ='rt')
 YAML.default_style = "|"
 
+def write_atomic(path: str, data: str):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
 class PromptSection:
     __metaclass__ = ABCMeta
 
@@ -25,6 +35,10 @@ class PromptSection:
     def serialize_config(self) -> Dict[str, Any]:
         pass
 
+    def render(self, facts_by_character: Optional[Dict[str, List[str]]] = None) -> str:
+        # facts_by_character overrides the facts of the listed main characters
+        return str(self)
+
 class Text(PromptSection):
     def __init__(self, text: str):
         self.text = text
@@ -48,7 +62,10 @@ class ListSection(PromptSection):
         self.items = items
 
     def __str__(self):
-        bullets = "\n\n".join(f"{i + 1}: {str(item)}" for i, item in enumerate(self.items))
+        return self.render()
+
+    def render(self, facts_by_character: Optional[Dict[str, List[str]]] = None) -> str:
+        bullets = "\n\n".join(f"{i + 1}: {item.render(facts_by_character)}" for i, item in enumerate(self.items))
         return \
             f"""{self.title}
             
@@ -82,10 +99,21 @@ class MainCharacter(PromptSection):
         self.core_facts = core_facts
         self.recent_facts = recent_facts
         self.message_examples = message_examples
+        # If set, facts are shuffled the same way on every render
+        self.shuffle_seed: Optional[int] = None
 
     def __str__(self):
-        facts = self.core_facts + self.recent_facts
-        random.shuffle(facts)
+        return self.render()
+
+    def render(self, facts_by_character: Optional[Dict[str, List[str]]] = None) -> str:
+        if facts_by_character is not None and self.name in facts_by_character:
+            facts = facts_by_character[self.name]
+        else:
+            facts = self.core_facts + self.recent_facts
+            if self.shuffle_seed is None:
+                random.shuffle(facts)
+            else:
+                random.Random(f"{self.shuffle_seed}:{self.name}").shuffle(facts)
         facts_str = "\n".join(f"* {fact}" for fact in facts)
         message_examples = "\n".join(f"* {message}" for message in self.message_examples)
         return \
@@ -117,14 +145,31 @@ class MainCharacter(PromptSection):
         return result
 
 class Prompt:
-    def __init__(self, config_path: str):
+    def __init__(self, config_path: str, stable: bool = False):
         self.config_path = config_path
         with open(config_path, "r") as f:
-            _config = YAML.load(f)
-        self.config = Prompt.parse_config(_config)
+            raw_config = f.read()
+        self.config = Prompt.parse_config(YAML.load(raw_config))
+        if stable:
+            # Seed the shuffle with the config contents so that the rendered prompt is
+            # byte-identical until the config changes, keeping provider prefix caches warm
+            Prompt._set_shuffle_seed(self.config, zlib.crc32(raw_config.encode("utf-8")))
 
-    def print(self):
-        return "\n\n".join(str(c) for c in self.config)
+    def print(self, facts_by_character: Optional[Dict[str, List[str]]] = None):
+        return "\n\n".join(c.render(facts_by_character) for c in self.config)
+
+    def main_characters(self) -> List[MainCharacter]:
+        return Prompt._main_characters(self.config)
+
+    @classmethod
+    def _main_characters(cls, components: List[PromptSection]) -> List[MainCharacter]:
+        result = []
+        for component in components:
+            if isinstance(component, MainCharacter):
+                result.append(component)
+            if isinstance(component, ListSection):
+                result.extend(cls._main_characters(component.items))
+        return result
 
     @classmethod
     def parse_config(cls, config) -> List[PromptSection]:
@@ -139,8 +184,40 @@ class Prompt:
                 components.append(MainCharacter.parse(block))
         return components
 
-    def save_config(self, path: str):
+    @classmethod
+    def _set_shuffle_seed(cls, components: List[PromptSection], seed: int):
+        for character in cls._main_characters(components):
+            character.shuffle_seed = seed
+
+    def dumps(self) -> str:
         result = [component.serialize_config() for component in self.config]
-        print(result)
-        with open(path, "w", encoding="utf-8") as f:
-            YAML.dump(result, f)
\ No newline at end of file
+        stream = io.StringIO()
+        YAML.dump(result, stream)
+        return stream.getvalue()
+
+    def save_config(self, path: str):
+        write_atomic(path, self.dumps())
+
+# Process-wide cache of stable rendered prompts, keyed on the config file's inode/mtime/size.
+# Unstable prompts are reshuffled on every call, so they are never cached.
+class PromptCache:
+    def __init__(self):
+        self._entries: Dict[str, Tuple[Tuple[int, int, int], str]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, config_path: str, stable: bool = False) -> str:
+        if not stable:
+            return Prompt(config_path).print()
+        stat = os.stat(config_path)
+        key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            entry = self._entries.get(config_path)
+            if entry is not None and entry[0] == key:
+                return entry[1]
+
+        rendered = Prompt(config_path, stable).print()
+        with self._lock:
+            self._entries[config_path] = (key, rendered)
+        return rendered
+
+PROMPT_CACHE = PromptCache()
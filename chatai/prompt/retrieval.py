@@ -0,0 +1,150 @@
+import os
+import re
+import threading
+import zlib
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+import numpy as np
+
+from chatai.prompt.prompt import Prompt
+
+
+class HashedEmbedder:
+    # Hashed bag of words and character n-grams; needs no model and runs fully offline
+    def __init__(self, dim: int = 1024, ngram_size: int = 4):
+        self.dim = dim
+        self.ngram_size = ngram_size
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        result = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature in self._features(text):
+                h = zlib.crc32(feature.encode("utf-8"))
+                result[row, h % self.dim] += 1.0 if h & (1 << 31) else -1.0
+        norms = np.linalg.norm(result, axis=1, keepdims=True)
+        return result / np.maximum(norms, 1e-9)
+
+    def _features(self, text: str) -> List[str]:
+        features = []
+        for word in re.findall(r"\w+", text.lower()):
+            features.append(word)
+            padded = f" {word} "
+            features.extend(padded[i:i + self.ngram_size] for i in range(max(len(padded) - self.ngram_size + 1, 1)))
+        return features
+
+class SentenceTransformerEmbedder:
+    # Local sentence-transformers model, loaded from the local cache or a path
+    def __init__(self, model_name: str):
+        from sentence_transformers import SentenceTransformer
+        self.model = SentenceTransformer(model_name, local_files_only=True)
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        return self.model.encode(texts, normalize_embeddings=True, convert_to_numpy=True).astype(np.float32)
+
+def create_embedder(config: Dict[str, ...]):
+    if config.get("embedding_model"):
+        try:
+            return SentenceTransformerEmbedder(config["embedding_model"])
+        except (ImportError, OSError) as e:
+            print(f"Falling back to hashed embeddings: {e}")
+    return HashedEmbedder(config.get("dim", 1024))
+
+class FactIndex:
+    # Brute-force cosine search; the number of facts is small enough for one matrix product
+    def __init__(self, facts: List[Tuple[str, str]], embeddings: np.ndarray):
+        self.facts = facts
+        self.embeddings = embeddings
+        self.character_names = np.array([character_name for character_name, _ in facts], dtype=object)
+
+    @staticmethod
+    def build(facts: List[Tuple[str, str]], embedder) -> 'FactIndex':
+        facts = list(dict.fromkeys(facts))
+        embeddings = embedder.embed([fact for _, fact in facts]) if facts else np.zeros((0, 1), dtype=np.float32)
+        return FactIndex(facts, embeddings)
+
+    def search(self, query: np.ndarray, top_k: int, boosted_characters: Set[str], boost: float) -> List[Tuple[str, str]]:
+        if not self.facts:
+            return []
+        scores = self.embeddings @ query
+        if boosted_characters:
+            scores = scores + boost * np.isin(self.character_names, list(boosted_characters))
+        top_k = min(top_k, len(self.facts))
+        best = np.argpartition(-scores, top_k - 1)[:top_k]
+        best = best[np.argsort(-scores[best])]
+        return [self.facts[i] for i in best]
+
+class FactRetriever:
+    # Renders the system prompt with only the character facts relevant to the current messages.
+    # The prompt and its index are rebuilt when the config file changes.
+    def __init__(
+            self,
+            embedder,
+            top_k: int,
+            character_boost: float,
+            load_extra_facts: Optional[Callable[[], List[Tuple[str, str]]]] = None,
+    ):
+        self.embedder = embedder
+        self.top_k = top_k
+        self.character_boost = character_boost
+        self.load_extra_facts = load_extra_facts
+        self._entries: Dict[str, Tuple[Tuple[int, int, int], Prompt, FactIndex]] = {}
+        self._lock = threading.Lock()
+        # Held while rebuilding, so concurrent callers wait for one rebuild instead of each running their own
+        self._build_lock = threading.Lock()
+
+    def render(self, config_path: str, query_text: str, speaker_names: Set[str]) -> str:
+        prompt, index = self._get(config_path)
+
+        # Characters who wrote or are mentioned in the messages get their facts boosted
+        lowered_query = query_text.lower()
+        involved = set(speaker_names)
+        for character in prompt.main_characters():
+            if character.name.lower() in lowered_query or (character.nickname and character.nickname.lower() in lowered_query):
+                involved.add(character.name)
+
+        query = self.embedder.embed([query_text])[0]
+        facts_by_character = {character.name: [] for character in prompt.main_characters()}
+        for character_name, fact in index.search(query, self.top_k, involved, self.character_boost):
+            if character_name in facts_by_character:
+                facts_by_character[character_name].append(fact)
+        return prompt.print(facts_by_character)
+
+    def refresh(self, config_path: str):
+        # Rebuilds the index if the config changed. Async callers run this in a thread before render(),
+        # so the fact query and the embedding of every fact don't block the event loop.
+        self._get(config_path)
+
+    def _get(self, config_path: str) -> Tuple[Prompt, FactIndex]:
+        entry = self._lookup(config_path)
+        if entry is not None:
+            return entry
+        with self._build_lock:
+            entry = self._lookup(config_path)
+            if entry is not None:
+                return entry
+            return self._build(config_path)
+
+    def _lookup(self, config_path: str) -> Optional[Tuple[Prompt, FactIndex]]:
+        stat = os.stat(config_path)
+        key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            entry = self._entries.get(config_path)
+            if entry is not None and entry[0] == key:
+                return entry[1], entry[2]
+        return None
+
+    def _build(self, config_path: str) -> Tuple[Prompt, FactIndex]:
+        stat = os.stat(config_path)
+        key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        prompt = Prompt(config_path)
+        facts = [
+            (character.name, fact)
+            for character in prompt.main_characters()
+            for fact in character.core_facts + character.recent_facts
+        ]
+        if self.load_extra_facts is not None:
+            facts.extend(self.load_extra_facts())
+        index = FactIndex.build(facts, self.embedder)
+        with self._lock:
+            self._entries[config_path] = (key, prompt, index)
+        return prompt, index
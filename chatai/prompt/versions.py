@@ -0,0 +1,78 @@
+import hashlib
+import os
+from typing import List, Optional
+
+from chatai.prompt.prompt import Prompt, write_atomic
+
+
+# Content-addressed prompt snapshots. Publishing writes <hash>.yaml and <hash>.txt and then
+# atomically replaces the live files, so readers see either the old or the new prompt, never a partial one.
+# The live file gets a new inode on every publish, which PromptCache picks up with a single stat.
+class PromptVersions:
+    def __init__(self, root: str, config_path: str, text_path: str):
+        self.root = root
+        self.config_path = config_path
+        self.text_path = text_path
+        os.makedirs(root, exist_ok=True)
+
+    def publish(self, prompt: Prompt) -> str:
+        config = prompt.dumps()
+        version = hashlib.sha256(config.encode("utf-8")).hexdigest()[:16]
+        if not os.path.exists(self._snapshot_path(version, "yaml")):
+            write_atomic(self._snapshot_path(version, "txt"), prompt.print())
+            write_atomic(self._snapshot_path(version, "yaml"), config)
+        self._activate(version, self._push(self.history(), version))
+        return version
+
+    def rollback(self, version: Optional[str] = None) -> str:
+        # History is a stack with the live version on top. Without an explicit version the top is popped,
+        # so repeated rollbacks keep walking back; an explicit version is pushed like a publish.
+        history = self.history()
+        if version is None:
+            if len(history) < 2:
+                raise ValueError("No earlier prompt version to roll back to")
+            history = history[:-1]
+            version = history[-1]
+        else:
+            if not os.path.exists(self._snapshot_path(version, "yaml")):
+                raise ValueError(f"Unknown prompt version {version}")
+            history = self._push(history, version)
+        self._activate(version, history)
+        return version
+
+    def current(self) -> Optional[str]:
+        try:
+            with open(self._pointer_path(), "r") as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def history(self) -> List[str]:
+        try:
+            with open(self._history_path(), "r") as f:
+                return [line.strip() for line in f if line.strip()]
+        except FileNotFoundError:
+            return []
+
+    def _activate(self, version: str, history: List[str]):
+        # Live files are rewritten even for the current version, which restores them after a manual edit
+        with open(self._snapshot_path(version, "txt"), "r", encoding="utf-8") as f:
+            write_atomic(self.text_path, f.read())
+        with open(self._snapshot_path(version, "yaml"), "r", encoding="utf-8") as f:
+            write_atomic(self.config_path, f.read())
+        write_atomic(self._pointer_path(), version)
+        write_atomic(self._history_path(), "".join(f"{v}\n" for v in history))
+        print(f"Published prompt version {version}")
+
+    @staticmethod
+    def _push(history: List[str], version: str) -> List[str]:
+        return history if history and history[-1] == version else history + [version]
+
+    def _snapshot_path(self, version: str, extension: str) -> str:
+        return os.path.join(self.root, f"{version}.{extension}")
+
+    def _pointer_path(self) -> str:
+        return os.path.join(self.root, "current")
+
+    def _history_path(self) -> str:
+        return os.path.join(self.root, "history")
@@ -3,6 +3,11 @@ from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 
 
-engine = create_engine(os.getenv("DATABASE_URI"))
-
-Session = sessionmaker(bind=engine)
+# The engine is created on first use, so importing the table definitions doesn't need a database
+def __getattr__(name: str):
+    if name not in ("engine", "Session"):
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    global engine, Session
+    engine = create_engine(os.getenv("DATABASE_URI"))
+    Session = sessionmaker(bind=engine)
+    return globals()[name]
@@ -1,6 +1,115 @@
+import base64
+
+from sqlalchemy import delete, inspect, text
+from sqlalchemy.engine import Engine
+
 from chatai.sql import engine
-from chatai.sql.tables import Base
+from chatai.sql.tables import Base, MessageImage, Memory
+from chatai.sql.writer import insert_ignore
+
+
+MIGRATION_CHUNK_SIZE = 500
+
+def migrate(engine: Engine):
+    Base.metadata.create_all(engine)
+
+    image_columns = {column["name"] for column in inspect(engine).get_columns("message_images")}
+    if "chat_id" not in image_columns:
+        print("Adding chats to message_images...")
+        with engine.begin() as connection:
+            connection.execute(text("ALTER TABLE message_images ADD COLUMN chat_id BIGINT"))
+            connection.execute(text(
+                "UPDATE message_images SET chat_id = "
+                "(SELECT chat_id FROM messages WHERE messages.id = message_images.message_id)"
+            ))
+
+    message_columns = {column["name"] for column in inspect(engine).get_columns("messages")}
+    if "image_b64_encoded" in message_columns:
+        print("Moving inline images to message_images...")
+        move_inline_images(engine)
+        with engine.begin() as connection:
+            connection.execute(text("ALTER TABLE messages DROP COLUMN image_b64_encoded"))
+
+    memory_columns = {column["name"] for column in inspect(engine).get_columns("memories")}
+    if "fact_hash" not in memory_columns:
+        print("Hashing memories...")
+        with engine.begin() as connection:
+            connection.execute(text("ALTER TABLE memories ADD COLUMN fact_hash VARCHAR(64)"))
+        hash_facts(engine)
+
+    batch_job_columns = {column["name"] for column in inspect(engine).get_columns("batch_jobs")}
+    if "error_file_id" not in batch_job_columns:
+        with engine.begin() as connection:
+            connection.execute(text("ALTER TABLE batch_jobs ADD COLUMN error_file_id VARCHAR(64)"))
+    if "end_unixtime" not in batch_job_columns:
+        with engine.begin() as connection:
+            connection.execute(text("ALTER TABLE batch_jobs ADD COLUMN end_unixtime INTEGER"))
+
+    # Indexes added to existing tables; after the data migrations so that unique indexes can be built
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+
+def move_inline_images(engine: Engine):
+    # Keyset pagination keeps each chunk in its own short transaction
+    last_id = None
+    moved = 0
+    while True:
+        with engine.begin() as connection:
+            rows = connection.execute(
+                text(
+                    "SELECT id, chat_id, image_b64_encoded FROM messages "
+                    "WHERE image_b64_encoded IS NOT NULL"
+                    + (" AND id > :last_id" if last_id is not None else "")
+                    + " ORDER BY id LIMIT :limit"
+                ),
+                {"last_id": last_id, "limit": MIGRATION_CHUNK_SIZE},
+            ).all()
+            if not rows:
+                break
+            connection.execute(
+                insert_ignore(MessageImage.__table__, connection.dialect.name).values([
+                    {"message_id": row.id, "chat_id": row.chat_id, "data": base64.b64decode(row.image_b64_encoded)}
+                    for row in rows
+                ])
+            )
+        last_id = rows[-1].id
+        moved += len(rows)
+        print(f"Moved {moved} images")
+
+def hash_facts(engine: Engine):
+    # Fills memories.fact_hash and drops duplicate facts, keeping the earliest row
+    last_id = 0
+    seen = set()
+    hashed = 0
+    while True:
+        with engine.begin() as connection:
+            rows = connection.execute(
+                text(
+                    "SELECT id, chat_id, character_name, fact FROM memories "
+                    "WHERE id > :last_id ORDER BY id LIMIT :limit"
+                ),
+                {"last_id": last_id, "limit": MIGRATION_CHUNK_SIZE},
+            ).all()
+            if not rows:
+                break
+            duplicate_ids = []
+            for row in rows:
+                fact_hash = Memory.hash_fact(row.character_name, row.fact)
+                if (row.chat_id, fact_hash) in seen:
+                    duplicate_ids.append(row.id)
+                    continue
+                seen.add((row.chat_id, fact_hash))
+                connection.execute(
+                    text("UPDATE memories SET fact_hash = :fact_hash WHERE id = :id"),
+                    {"fact_hash": fact_hash, "id": row.id},
+                )
+            if duplicate_ids:
+                connection.execute(delete(Memory.__table__).where(Memory.__table__.c.id.in_(duplicate_ids)))
+        last_id = rows[-1].id
+        hashed += len(rows)
+        print(f"Hashed {hashed} memories")
 
 
 if __name__ == "__main__":
-    Base.metadata.create_all(engine)
\ No newline at end of file
+    migrate(engine)
@@ -1,4 +1,7 @@
-from sqlalchemy import BigInteger, Numeric, Column, Integer, String
+import hashlib
+
+from sqlalchemy import BigInteger, Numeric, Column, Index, Integer, LargeBinary, String
+from sqlalchemy.dialects import mysql
 from sqlalchemy.ext.declarative import declarative_base
 
 
@@ -6,21 +9,40 @@ Base = declarative_base()
 
 class Message(Base):
     __tablename__ = 'messages'
+    __table_args__ = (
+        Index("ix_messages_chat_id_unixtime", "chat_id", "unixtime"),
+    )
 
     id = Column(BigInteger, primary_key=True, autoincrement=False)
     chat_id = Column(BigInteger, nullable=True)
     username = Column(String, nullable=True)
     text = Column(String, nullable=True)
     unixtime = Column(Integer, nullable=True)
-    image_b64_encoded = Column(String, nullable=True)
     reply_to_message_id = Column(BigInteger, nullable=True)
 
     def __repr__(self):
         fields = {col.name: getattr(self, col.name) for col in self.__table__.columns}
         return f"<{self.__class__.__name__}({fields})>"
 
+class MessageImage(Base):
+    __tablename__ = 'message_images'
+
+    message_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    # Message ids are only unique within a chat, so joins to messages also match on the chat
+    chat_id = Column(BigInteger, nullable=True)
+    # Raw JPEG bytes; BLOB on MySQL is capped at 64KB
+    data = Column(LargeBinary().with_variant(mysql.LONGBLOB(), "mysql", "mariadb"), nullable=False)
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__}(message_id={self.message_id}, {len(self.data)} bytes)>"
+
 class Memory(Base):
     __tablename__ = 'memories'
+    __table_args__ = (
+        Index("ix_memories_start_unixtime", "start_unixtime"),
+        # Re-extracting the same fact is a no-op
+        Index("uq_memories_chat_id_fact_hash", "chat_id", "fact_hash", unique=True),
+    )
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     chat_id = Column(BigInteger, nullable=True)
@@ -29,6 +51,48 @@ class Memory(Base):
     character_name = Column(String, nullable=True)
     fact = Column(String, nullable=True)
     interest_score = Column(Numeric, nullable=True)
+    # sha256 of character_name and fact, see Memory.hash_fact
+    fact_hash = Column(String(64), nullable=True)
+
+    @staticmethod
+    def hash_fact(character_name: str, fact: str) -> str:
+        return hashlib.sha256(f"{character_name}\n{fact}".encode("utf-8")).hexdigest()
+
+    def __repr__(self):
+        fields = {col.name: getattr(self, col.name) for col in self.__table__.columns}
+        return f"<{self.__class__.__name__}({fields})>"
+
+class ExtractionWatermark(Base):
+    __tablename__ = 'extraction_watermarks'
+
+    chat_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    # Messages before this time have been extracted
+    end_unixtime = Column(Integer, nullable=False)
+    updated_unixtime = Column(Integer, nullable=True)
+
+    def __repr__(self):
+        fields = {col.name: getattr(self, col.name) for col in self.__table__.columns}
+        return f"<{self.__class__.__name__}({fields})>"
+
+class BatchJob(Base):
+    __tablename__ = 'batch_jobs'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    name = Column(String(255), nullable=False)
+    # sha256 of the input JSONL, so that resubmitting identical requests resumes the existing job
+    content_hash = Column(String(64), nullable=False, unique=True)
+    input_file_id = Column(String(64), nullable=True)
+    batch_id = Column(String(64), nullable=True)
+    status = Column(String(32), nullable=True)
+    output_file_id = Column(String(64), nullable=True)
+    # Requests that failed inside the batch; a batch where every request failed has only this file
+    error_file_id = Column(String(64), nullable=True)
+    # End of the range the submitting run planned; a resumed run plans up to it again instead of up to now
+    end_unixtime = Column(Integer, nullable=True)
+    created_unixtime = Column(Integer, nullable=True)
+    updated_unixtime = Column(Integer, nullable=True)
+    # Set once the output has been processed
+    consumed_unixtime = Column(Integer, nullable=True)
 
     def __repr__(self):
         fields = {col.name: getattr(self, col.name) for col in self.__table__.columns}
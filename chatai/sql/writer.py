@@ -0,0 +1,97 @@
+import asyncio
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import Table, insert
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Engine
+
+
+# Rows are buffered in memory and written by a background task in multi-row INSERTs,
+# either every flush_interval_ms or as soon as max_batch_rows rows are queued
+class WriteBehindQueue:
+    def __init__(self, engine: Engine, flush_interval_ms: int, max_batch_rows: int):
+        self.engine = engine
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_batch_rows = max_batch_rows
+        self.queue: asyncio.Queue[Optional[Tuple[Table, Dict[str, Any]]]] = asyncio.Queue()
+        self.written_rows = 0
+        self.failed_rows = 0
+        self.flushes = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def put(self, table: Table, row: Dict[str, Any]):
+        self.queue.put_nowait((table, row))
+
+    @property
+    def queue_depth(self) -> int:
+        return self.queue.qsize()
+
+    def metrics(self) -> Dict[str, int]:
+        return {
+            "queue_depth": self.queue_depth,
+            "written_rows": self.written_rows,
+            "failed_rows": self.failed_rows,
+            "flushes": self.flushes,
+        }
+
+    async def close(self):
+        # The sentinel makes the background task flush everything queued before it and exit
+        if self._task is not None:
+            self.queue.put_nowait(None)
+            await self._task
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self.queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.max_batch_rows:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._flush(batch)
+
+    async def _flush(self, batch: List[Tuple[Table, Dict[str, Any]]]):
+        rows_by_table = defaultdict(list)
+        for table, row in batch:
+            rows_by_table[table].append(row)
+        try:
+            await asyncio.to_thread(self._write, rows_by_table)
+            self.written_rows += len(batch)
+        except Exception as e:
+            # Any failure drops only this batch; the writer keeps running for the rows behind it
+            self.failed_rows += len(batch)
+            print(f"Error writing {len(batch)} rows: {e}")
+        self.flushes += 1
+
+    def _write(self, rows_by_table: Dict[Table, List[Dict[str, Any]]]):
+        with self.engine.begin() as connection:
+            for table, rows in rows_by_table.items():
+                connection.execute(insert_ignore(table, connection.dialect.name).values(rows))
+
+def insert_ignore(table: Table, dialect_name: str):
+    # Rows that already exist are kept as they are
+    if dialect_name == "sqlite":
+        return sqlite.insert(table).on_conflict_do_nothing()
+    if dialect_name == "postgresql":
+        return postgresql.insert(table).on_conflict_do_nothing()
+    if dialect_name in ("mysql", "mariadb"):
+        return insert(table).prefix_with("IGNORE")
+    return insert(table)
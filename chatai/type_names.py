@@ -9,6 +9,8 @@ class ChatMessage:
     unixtime: int
     image_b64_encoded: Optional[str] = None
     reply_to_message: Optional['ChatMessage'] = None
+    # Handle in chatai.image.ImageStore; encoded to base64 only when building a request
+    image_handle: Optional[str] = None
 
 class ImageUrl(TypedDict):
     url: str
@@ -1,34 +1,116 @@
-from collections import deque
-import threading
-from typing import List, Tuple
+import asyncio
+import bisect
+import hashlib
+from collections import OrderedDict, deque
+from typing import Deque, List, Optional, Tuple
 from itertools import islice
 
-from chatai.type_names import ChatMessage
+from chatai.type_names import ChatMessage, TypedContent
 
-class MessageCache:
+class _ChatBuffer:
     def __init__(self, max_size: int):
-        self.queue = deque()
+        # Ring buffer of (timestamp, message), sorted by timestamp
+        self.queue: Deque[Tuple[int, ChatMessage]] = deque(maxlen=max_size)
+        self.lock = asyncio.Lock()
+
+class MessageCache:
+    def __init__(self, max_size: int, max_total_size: int):
         self.max_size = max_size
-        self.lock = threading.Lock()
-    
-    def add_message(self, message: ChatMessage):
-        with self.lock:
-            # Insertion sort to maintain the deque sorted by timestamp
+        self.max_total_size = max_total_size
+        # chat_id -> buffer, least recently used first
+        self.chats: OrderedDict[int, _ChatBuffer] = OrderedDict()
+        self.total_size = 0
+
+    def _get_buffer(self, chat_id: int) -> _ChatBuffer:
+        buffer = self.chats.get(chat_id)
+        if buffer is None:
+            buffer = _ChatBuffer(self.max_size)
+            self.chats[chat_id] = buffer
+        else:
+            self.chats.move_to_end(chat_id)
+        return buffer
+
+    async def add_message(self, chat_id: int, message: ChatMessage):
+        buffer = self._get_buffer(chat_id)
+        async with buffer.lock:
+            queue = buffer.queue
             timestamp = message.unixtime
-            if not self.queue or self.queue[-1][0] <= timestamp:
-                self.queue.append((timestamp, message))
-            else:
-                for idx in range(len(self.queue)):
-                    if self.queue[idx][0] < timestamp:
-                        self.queue.insert(idx, (timestamp, message))
-                        break
-            
-            # Trim the deque if it exceeds the max size
-            if len(self.queue) > self.max_size:
-                self.queue.popleft()
-
-    def get_last_n_messages(self, n: int) -> List[ChatMessage]:
-        with self.lock:
-            # Use islice to efficiently get the last n elements without copying
-            retval = list(islice(self.queue, max(len(self.queue) - n, 0), len(self.queue)))
-            return [x[1] for x in retval]
\ No newline at end of file
+            size_before = len(queue)
+            if not queue or queue[-1][0] <= timestamp:
+                queue.append((timestamp, message))
+            elif len(queue) < self.max_size or queue[0][0] <= timestamp:
+                # Out-of-order message: binary search for its position
+                if len(queue) == self.max_size:
+                    queue.popleft()
+                idx = bisect.bisect_right(queue, timestamp, key=lambda x: x[0])
+                queue.insert(idx, (timestamp, message))
+            # Otherwise the message is older than everything in a full buffer
+            self.total_size += len(queue) - size_before
+
+        self._evict_idle_chats(chat_id)
+
+    def _evict_idle_chats(self, active_chat_id: int):
+        while self.total_size > self.max_total_size and len(self.chats) > 1:
+            chat_id, buffer = next(iter(self.chats.items()))
+            if chat_id == active_chat_id:
+                break
+            del self.chats[chat_id]
+            self.total_size -= len(buffer.queue)
+
+    async def get_last_n_messages(self, chat_id: int, n: int) -> List[ChatMessage]:
+        buffer = self._get_buffer(chat_id)
+        async with buffer.lock:
+            # Walk from the newest end so the cost depends only on n
+            retval = list(islice(reversed(buffer.queue), n))
+            return [x[1] for x in reversed(retval)]
+
+
+class EncodingCache:
+    def __init__(self, max_bytes: int, max_item_bytes: int):
+        self.max_bytes = max_bytes
+        # Larger encodings (e.g. big images) are not cached so they can't pin the cache
+        self.max_item_bytes = max_item_bytes
+        self.entries: OrderedDict[tuple, Tuple[str | List[TypedContent], int]] = OrderedDict()
+        self.total_bytes = 0
+
+    @staticmethod
+    def key(message: ChatMessage) -> tuple:
+        # Images are keyed by content hash: the ImageStore handle, or a digest of an inline payload.
+        # Keys never hold image data, which the size limits only count in the cached values.
+        reply_key = EncodingCache.key(message.reply_to_message) if message.reply_to_message is not None else None
+        image_key = message.image_handle
+        if image_key is None and message.image_b64_encoded is not None:
+            image_key = hashlib.sha256(message.image_b64_encoded.encode("utf-8")).hexdigest()
+        return (
+            message.username,
+            message.text,
+            message.unixtime,
+            image_key,
+            reply_key,
+        )
+
+    def get(self, key: tuple) -> Optional[str | List[TypedContent]]:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key: tuple, content: str | List[TypedContent]):
+        size = EncodingCache._size(content)
+        if size > self.max_item_bytes or key in self.entries:
+            return
+        self.entries[key] = (content, size)
+        self.total_bytes += size
+        while self.total_bytes > self.max_bytes:
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.total_bytes -= evicted_size
+
+    @staticmethod
+    def _size(content: str | List[TypedContent]) -> int:
+        if isinstance(content, str):
+            return len(content)
+        return sum(
+            len(component["text"]) if component["type"] == "text" else len(component["image_url"]["url"])
+            for component in content
+        )
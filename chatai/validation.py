@@ -0,0 +1,234 @@
+import asyncio
+import json
+import os
+import random
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+import openai
+from openai import AsyncOpenAI, OpenAI
+from sqlalchemy.orm import Session
+
+from chatai.completion import AsyncCompletionBackend
+from chatai.memory.batch import submit_batch_task, wait_for_batch_tasks, iter_batch_output, report_batch_errors, mark_consumed
+from chatai.memory.plan import pack_requests
+from chatai.sql.tables import BatchJob
+
+
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APIConnectionError,
+    openai.APITimeoutError,
+    openai.InternalServerError,
+)
+
+@dataclass
+class ValidationParams:
+    # "online": concurrent completions conditioned on earlier generations;
+    # "batch": teacher-forced turns through the Batch API, cheaper but only done within 24h
+    prediction_mode: str = "online"
+    max_concurrent_requests: int = 16
+    max_retries: int = 5
+    initial_backoff_seconds: float = 2.0
+    max_tokens: int = 150
+    temperature: float = 0.7
+    checkpoint_dir: str = "validation_checkpoints"
+    # Online mode only: None, "read_write", "record" or "replay"; replay runs fully offline from recorded responses
+    cache_mode: Optional[str] = None
+    cache_path: str = "validation_checkpoints/completions.sqlite"
+
+@dataclass
+class PredictionRow:
+    conversation_idx: int
+    message_idx: int
+    role: str
+    original: str
+    generated: str
+
+# Generates the assistant turns of validation conversations. Conversations run concurrently,
+# turns within a conversation run in order since each one is conditioned on the previous generations.
+# Finished conversations are appended to a JSONL checkpoint, and a rerun skips them.
+class ValidationRunner:
+    def __init__(self, backend: AsyncCompletionBackend, vendor: str, model_id: str, params: ValidationParams, checkpoint_path: str):
+        self.backend = backend
+        self.vendor = vendor
+        self.model_id = model_id
+        self.params = params
+        self.checkpoint_path = checkpoint_path
+
+    async def run(self, conversations: List[Dict[str, ...]]) -> List[PredictionRow]:
+        done = self._load_checkpoint()
+        pending = [i for i in range(len(conversations)) if i not in done]
+        print(f"Generating predictions for {len(pending)} conversations ({len(done)} already in checkpoint)")
+
+        os.makedirs(os.path.dirname(self.checkpoint_path) or ".", exist_ok=True)
+        results = await asyncio.gather(
+            *(self._run_conversation(i, conversations[i]["messages"]) for i in pending),
+            return_exceptions=True,
+        )
+        failed = 0
+        for conversation_idx, result in zip(pending, results):
+            if isinstance(result, Exception):
+                failed += 1
+                print(f"Error generating predictions for conversation {conversation_idx}: {result!r}")
+                continue
+            done[conversation_idx] = result
+        if failed:
+            print(f"{failed} conversations failed, rerun to retry them")
+        return [row for i in sorted(done) for row in done[i]]
+
+    async def _run_conversation(self, conversation_idx: int, messages: List[Dict[str, str]]) -> List[PredictionRow]:
+        generated_completions = []
+        rows = []
+        for message_idx, message in enumerate(messages):
+            if message["role"] == "assistant":
+                content = await self._complete(generated_completions)
+                generated_completions.append({"role": "assistant", "content": content})
+            else:
+                generated_completions.append(message)
+            rows.append(PredictionRow(
+                conversation_idx,
+                message_idx,
+                generated_completions[-1]["role"],
+                message["content"],
+                generated_completions[-1]["content"],
+            ))
+        self._append_checkpoint(conversation_idx, rows)
+        return rows
+
+    async def _complete(self, messages: List[Dict[str, str]]) -> str:
+        backoff = self.params.initial_backoff_seconds
+        for attempt in range(self.params.max_retries + 1):
+            try:
+                response = await self.backend.create(
+                    self.vendor,
+                    use_cache=True,
+                    model=self.model_id,
+                    messages=messages,
+                    max_tokens=self.params.max_tokens,
+                    temperature=self.params.temperature,
+                )
+                return (response.choices[0].message.content or "").strip()
+            except RETRYABLE_ERRORS as e:
+                if attempt == self.params.max_retries:
+                    raise
+                print(f"Retrying completion in {backoff:.1f}s: {e!r}")
+                await asyncio.sleep(backoff * (1 + random.random()))
+                backoff *= 2
+
+    def _load_checkpoint(self) -> Dict[int, List[PredictionRow]]:
+        done = dict()
+        if not os.path.exists(self.checkpoint_path):
+            return done
+        with open(self.checkpoint_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # The last line may be cut off by a crash
+                    continue
+                if record["model_id"] != self.model_id:
+                    continue
+                done[record["conversation_idx"]] = [PredictionRow(**row) for row in record["rows"]]
+        return done
+
+    def _append_checkpoint(self, conversation_idx: int, rows: List[PredictionRow]):
+        record = {
+            "model_id": self.model_id,
+            "conversation_idx": conversation_idx,
+            "rows": [row.__dict__ for row in rows],
+        }
+        with open(self.checkpoint_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+# Teacher-forced evaluation through the Batch API: every assistant turn is predicted from the original
+# history, so all turns are independent and go into the same batch file(s).
+class BatchValidationRunner:
+    def __init__(self, session: Session, client: OpenAI, async_client: AsyncOpenAI, model_id: str, params: ValidationParams, name: str):
+        self.session = session
+        self.client = client
+        self.async_client = async_client
+        self.model_id = model_id
+        self.params = params
+        self.name = name
+
+    async def run(self, conversations: List[Dict[str, ...]]) -> List[PredictionRow]:
+        requests = self._make_requests(conversations)
+        batches = pack_requests(requests)
+        print(f"Submitting {len(requests)} validation turns in {len(batches)} batches")
+        # Resubmitting the same conversations resumes the existing batches through the ledger
+        jobs = await asyncio.to_thread(self._submit, batches)
+        await wait_for_batch_tasks(self.session, self.async_client, jobs)
+        generated, failed = await asyncio.to_thread(self._read_outputs, jobs)
+        if failed or len(generated) < len(requests):
+            print(f"{len(requests) - len(generated)} of {len(requests)} validation turns have no prediction")
+
+        rows = []
+        for conversation_idx, conversation in enumerate(conversations):
+            for message_idx, message in enumerate(conversation["messages"]):
+                if message["role"] == "assistant":
+                    content = generated.get(BatchValidationRunner.custom_id(conversation_idx, message_idx), "")
+                else:
+                    content = message["content"]
+                rows.append(PredictionRow(conversation_idx, message_idx, message["role"], message["content"], content))
+        return rows
+
+    def _submit(self, batches: List[List[Dict[str, ...]]]) -> List[BatchJob]:
+        return [submit_batch_task(self.session, self.client, batch, f"{self.name}_{i}") for i, batch in enumerate(batches)]
+
+    def _read_outputs(self, jobs: List[BatchJob]) -> Tuple[Dict[str, str], int]:
+        generated = dict()
+        failed = 0
+        for job in jobs:
+            if job.status != "completed":
+                print(f"Skipping batch {job.batch_id} ({job.name}) with status {job.status}")
+                continue
+            if job.output_file_id is None:
+                print(f"Batch {job.batch_id} ({job.name}) has no output file")
+            else:
+                for line in iter_batch_output(self.client, job.output_file_id):
+                    try:
+                        custom_id, content = BatchValidationRunner._parse_line(line)
+                    except (ValueError, KeyError, TypeError, IndexError) as e:
+                        failed += 1
+                        print(f"Failed validation line: {e!r}")
+                        continue
+                    generated[custom_id] = content
+            failed += report_batch_errors(self.client, job)
+            if job.consumed_unixtime is None:
+                mark_consumed(self.session, job)
+        return generated, failed
+
+    @staticmethod
+    def custom_id(conversation_idx: int, message_idx: int) -> str:
+        return f"conv-{conversation_idx}-msg-{message_idx}"
+
+    def _make_requests(self, conversations: List[Dict[str, ...]]) -> List[Dict[str, ...]]:
+        requests = []
+        for conversation_idx, conversation in enumerate(conversations):
+            messages = conversation["messages"]
+            for message_idx, message in enumerate(messages):
+                if message["role"] != "assistant":
+                    continue
+                requests.append({
+                    "custom_id": BatchValidationRunner.custom_id(conversation_idx, message_idx),
+                    "method": "POST",
+                    "url": "/v1/chat/completions",
+                    "body": {
+                        "model": self.model_id,
+                        "messages": messages[:message_idx],
+                        "max_tokens": self.params.max_tokens,
+                        "temperature": self.params.temperature,
+                    },
+                })
+        return requests
+
+    @staticmethod
+    def _parse_line(line: str) -> Tuple[str, str]:
+        record = json.loads(line)
+        if record.get("error") is not None:
+            raise ValueError(f"{record['custom_id']}: {record['error']}")
+        response = record["response"]
+        if response["status_code"] != 200:
+            raise ValueError(f"{record['custom_id']}: status {response['status_code']}")
+        return record["custom_id"], (response["body"]["choices"][0]["message"]["content"] or "").strip()
@@ -64,7 +64,7 @@ function setup_virtualenv {
 # Function to install required Python libraries
 function install_python_libraries {
     echo_info "Installing required Python libraries..."
-    pip install python-telegram-bot openai pyyaml crontab sqlalchemy ruamel.yaml
+    pip install python-telegram-bot openai pyyaml crontab sqlalchemy ruamel.yaml pillow tiktoken numpy
     if [ $? -ne 0 ]; then
         echo_error "Error installing dependencies. If you're in a managed environment, consider using a virtual environment."
         echo_info "Instructions:"